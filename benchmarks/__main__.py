@@ -0,0 +1,55 @@
+import argparse
+import json
+import os.path
+import platform
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lang'))
+
+import cases
+import measure
+
+arg_parser = argparse.ArgumentParser(description='Measure parsing and execution against input size.')
+
+arg_parser.add_argument('case_names', nargs='*', metavar='case', help='cases to run (all by default): {}'.format(
+    ', '.join(repr(c.name) for c in cases.cases)))
+arg_parser.add_argument('--repeat', type=int, default=3, help='runs to take the best wall time of')
+arg_parser.add_argument('--quick', action='store_true', help='skip the largest size of each case')
+arg_parser.add_argument('--output', metavar='JSON', help='file to store the results in')
+arg_parser.add_argument('--compare', metavar='JSON', help='results of an earlier run to compare against')
+
+args = arg_parser.parse_args()
+
+selected_cases = [c for c in cases.cases if not args.case_names or c.name in args.case_names]
+unknown_names = set(args.case_names) - {c.name for c in cases.cases}
+if unknown_names:
+    arg_parser.error('unknown cases: {}'.format(', '.join(sorted(unknown_names))))
+
+baseline = {}
+if args.compare is not None:
+    with open(args.compare) as file:
+        baseline = json.load(file)['cases']
+
+results = {}
+for case in selected_cases:
+    sizes = case.sizes[:-1] if args.quick else case.sizes
+    measurements = []
+    print(case.name)
+    baseline_seconds = {m['size']: m['seconds'] for m in baseline.get(case.name, {}).get('measurements', ())}
+    for size in sizes:
+        m = measure.measure(case, size, repeat=args.repeat)
+        measurements.append(m)
+        line = '  {:>6}  {:9.4f} s  {:9.1f} KiB peak'.format(size, m['seconds'], m['peak_bytes'] / 1024)
+        if m['items_per_set'] is not None:
+            line += '  {:7.1f} items/set'.format(m['items_per_set'])
+        if size in baseline_seconds:
+            line += '  x{:.2f} of baseline'.format(m['seconds'] / baseline_seconds[size])
+        print(line)
+    exponent = measure.scaling_exponent(measurements)
+    if exponent is not None:
+        print('  scaling exponent {:.2f}'.format(exponent))
+    results[case.name] = {'measurements': measurements, 'scaling_exponent': exponent}
+
+if args.output is not None:
+    with open(args.output, 'w') as file:
+        json.dump({'python': platform.python_version(), 'repeat': args.repeat, 'cases': results}, file, indent=4)
@@ -0,0 +1,241 @@
+"""Benchmark cases. Each one prepares a run for an input size, returning a callable that does the measured work and
+returns the pearl.Parser it used, if any. The optional reset is called before every run, outside of the timing."""
+from collections import namedtuple as _namedtuple
+import atexit as _atexit
+import os as _os
+import os.path as _os_path
+import shutil as _shutil
+import string as _string
+import tempfile as _tempfile
+
+import core
+import pearl
+
+
+class Case(_namedtuple('Case', ['name', 'sizes', 'prepare', 'reset'])):
+    pass
+
+
+def _parse(grammar, text, **kwargs):
+    parser = pearl.Parser(grammar, **kwargs)
+    parser.feed(text)
+    parser.finish()
+    return parser
+
+
+_core_statements = [
+    'var v{i};\n',
+    'v{i} = f({i}, \'text {i}\', g.h);\n',
+    '# comment {i}\n',
+    'x.y{i} = (a, b) => {{ return a; }};\n',
+    'if c {{ d(); }} else {{ e({i}); }}\n',
+    '{{ var w; w = \'block\'; }}\n',
+]
+
+
+def generate_core_source(size):
+    """Source of about size characters using only core_grammar constructs."""
+    statements = []
+    length = 0
+    i = 0
+    while length < size:
+        statement = _core_statements[i % len(_core_statements)].format(i=i)
+        statements.append(statement)
+        length += len(statement)
+        i += 1
+    return ''.join(statements)
+
+
+def _prepare_core_source(size):
+    source = generate_core_source(size)
+    return lambda: _parse(core.core_grammar, source, allow_ambiguous=False, deferred=True)
+
+
+def _prepare_right_recursion(build_source):
+    def prepare(size):
+        source = build_source(size)
+        return lambda: _parse(core.core_grammar, source, allow_ambiguous=False, deferred=True)
+    return prepare
+
+
+_ambiguous = pearl.Grammar().extend([
+    ('__start__', [{'sum'}]),
+    ('sum', [{'sum'}, '+', {'sum'}], '({} + {})'.format),
+    ('sum', ['a']),
+])
+
+
+def _prepare_ambiguous(size):
+    source = '+'.join('a' * size)
+
+    def run():
+        parser = pearl.Parser(_ambiguous, output='forest')
+        parser.feed(source)
+        parser.finish().count()
+        return parser
+
+    return run
+
+
+_dynamic = pearl.Grammar().extend([
+    ('__start__', [{'action'}]),
+    ('action', ['.']),
+    ('action', ['!', {'char'}, (lambda g, c: g.put('action', [c, 'action'])), 'action']),
+    ('char', [pearl.CharacterClass(_string.ascii_lowercase)]),
+])
+
+
+def _prepare_dynamic(size):
+    chunks = []
+    length = 0
+    i = 0
+    while length < size:
+        letter = _string.ascii_lowercase[i % len(_string.ascii_lowercase)]
+        chunk = '!' + letter + letter * 8
+        chunks.append(chunk)
+        length += len(chunk)
+        i += 1
+    source = ''.join(chunks) + '.'
+    return lambda: _parse(_dynamic, source, allow_ambiguous=False)
+
+
+def _prepare_macros(size):
+    source = 'import \'/std/io\';\nimport \'/std/operators\';\n'
+    i = 0
+    while len(source) < size:
+        source += 'print({i} + 2 * {i} - 3 / 4 ^ 2 % 5);\n'.format(i=i)
+        i += 1
+    return lambda: _parse(core.core_grammar, source, allow_ambiguous=False, deferred=True)
+
+
+_directory = None
+
+
+def _write_module(name, source):
+    """Write source to a module in a temporary directory and return its path, without extension. The path is relative,
+    since absolute module paths refer to libraries."""
+    global _directory
+    if _directory is None:
+        _directory = _tempfile.mkdtemp(prefix='lang-benchmarks-')
+        _atexit.register(_shutil.rmtree, _directory, True)
+    path = _os_path.relpath(_os_path.join(_directory, name))
+    with open(path + '.lang', 'w') as file:
+        file.write(source)
+    return path
+
+
+def _clear_read_caches():
+    core._read._read.cache_clear()
+    core._core_grammar._get_grammar_patch.cache_clear()
+    pearl.clear_transform_cache()
+
+
+def _prepare_langc(size):
+    path = _write_module('langc_{}'.format(size), generate_core_source(size))
+
+    def run():
+        core.read(path)
+
+    return run
+
+
+def _reset_cold_langc(size):
+    path = _os_path.relpath(_os_path.join(_directory, 'langc_{}'.format(size)))
+    if _os_path.exists(path + '.langc'):
+        _os.remove(path + '.langc')
+    _clear_read_caches()
+
+
+def _reset_warm_langc(size):
+    path = _os_path.relpath(_os_path.join(_directory, 'langc_{}'.format(size)))
+    if not _os_path.exists(path + '.langc'):
+        core.read(path)
+    _clear_read_caches()
+
+
+def _get_import_graph_paths(size):
+    module_paths = [_os_path.relpath(_os_path.join(_directory, 'graph_{}_{}'.format(size, i))) for i in range(size)]
+    return _os_path.relpath(_os_path.join(_directory, 'graph_{}'.format(size))), module_paths
+
+
+def _prepare_import_graph(parallel):
+    def prepare(size):
+        for i in range(size):
+            _write_module('graph_{}_{}'.format(size, i), generate_core_source(2000))
+        path, module_paths = _get_import_graph_paths(size)
+        _write_module('graph_{}'.format(size), ''.join('import \'{}\';\n'.format(p) for p in module_paths))
+
+        def run():
+            if parallel:
+                core.preload(path)
+            core.read(path)
+
+        return run
+
+    return prepare
+
+
+def _reset_import_graph(size):
+    path, module_paths = _get_import_graph_paths(size)
+    for p in [path] + module_paths:
+        if _os_path.exists(p + '.langc'):
+            _os.remove(p + '.langc')
+    _clear_read_caches()
+
+
+def _reset_warm_import_graph(size):
+    path, _ = _get_import_graph_paths(size)
+    core.read(path)
+    _clear_read_caches()
+
+
+def _prepare_execution(compiled):
+    def prepare(size):
+        body = _read_loop(size)
+        if compiled:
+            return lambda: body.compile()(core.ast.Context())
+        return lambda: body.execute(core.ast.Context())
+    return prepare
+
+
+def _read_loop(size):
+    # break; also parses as an unused variable access, so the loop is left with return instead.
+    path = _write_module('loop_{}'.format(size), '''import '/std/types';
+import '/std/operators';
+import '/std/if';
+
+var count;
+count = (n) => {{
+    var i;
+    i = 0;
+    forever {{
+        i = i + 1;
+        if i.__ge__(n) {{
+            return i;
+        }}
+    }}
+}};
+count({size});
+'''.format(size=size))
+    return core.read(path)
+
+
+cases = [
+    Case('core source', (1000, 2000, 4000, 8000), _prepare_core_source, None),
+    Case('comment', (1000, 2000, 4000, 8000),
+         _prepare_right_recursion(lambda n: '# ' + 'x' * n + '\n'), None),
+    Case('string literal', (1000, 2000, 4000, 8000),
+         _prepare_right_recursion(lambda n: 'print(\'' + 'y' * n + '\');'), None),
+    Case('statement list', (1000, 2000, 4000, 8000),
+         _prepare_right_recursion(lambda n: 'x;\n' * (n // 3)), None),
+    Case('ambiguous', (8, 16, 32, 64), _prepare_ambiguous, None),
+    Case('dynamic', (250, 500, 1000, 2000), _prepare_dynamic, None),
+    Case('operator macros', (500, 1000, 2000, 4000), _prepare_macros, None),
+    Case('cold .langc', (1000, 2000, 4000, 8000), _prepare_langc, _reset_cold_langc),
+    Case('warm .langc', (1000, 2000, 4000, 8000), _prepare_langc, _reset_warm_langc),
+    Case('serial import graph', (2, 4, 8), _prepare_import_graph(False), _reset_import_graph),
+    Case('parallel import graph', (2, 4, 8), _prepare_import_graph(True), _reset_import_graph),
+    Case('warm import graph', (2, 4, 8, 16), _prepare_import_graph(False), _reset_warm_import_graph),
+    Case('execution loop', (1000, 2000, 4000, 8000), _prepare_execution(False), None),
+    Case('compiled execution loop', (1000, 2000, 4000, 8000), _prepare_execution(True), None),
+]
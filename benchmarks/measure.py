@@ -0,0 +1,57 @@
+"""Wall time, peak memory and scaling exponents of benchmark cases."""
+import gc
+import math
+import time
+import tracemalloc
+
+
+def measure(case, size, *, repeat):
+    """Measure case at size: the best wall time of repeat runs, the peak memory of one more run and, for parsing cases,
+    the mean number of items per Earley set."""
+    run = case.prepare(size)
+
+    seconds = None
+    parser = None
+    for _ in range(repeat):
+        if case.reset is not None:
+            case.reset(size)
+        gc.collect()
+        start = time.perf_counter()
+        parser = run()
+        elapsed = time.perf_counter() - start
+        if seconds is None or elapsed < seconds:
+            seconds = elapsed
+
+    if case.reset is not None:
+        case.reset(size)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    items_per_set = None
+    if parser is not None:
+        items_per_set = parser.item_count / (parser.position + 1)
+
+    return {
+        'size': size,
+        'seconds': seconds,
+        'peak_bytes': peak_bytes,
+        'items_per_set': items_per_set,
+    }
+
+
+def scaling_exponent(measurements):
+    """Least squares slope of log(seconds) against log(size): about 1 for linear cases, 2 for quadratic ones."""
+    points = [(math.log(m['size']), math.log(m['seconds'])) for m in measurements if m['seconds'] > 0]
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    variance = sum((x - mean_x) ** 2 for x, _ in points)
+    if variance == 0:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
@@ -1,20 +1,147 @@
 import argparse
+import os
 import sys
+import time
 
-import core
-import pearl
+import server
 
-arg_parser = argparse.ArgumentParser()
+# core and pearl are imported where used, so that clients of the compile server start without building core_grammar.
 
-arg_parser.add_argument('source_file', help='(without extension)')
 
-args = arg_parser.parse_args()
+def main():
+    arg_parser = get_arg_parser()
+    args = arg_parser.parse_args()
 
-try:
-    module = core.Module(args.source_file)
-except Exception as e:
-    if e.__cause__.__class__ != pearl.AmbiguousParse:
-        raise
-    print(e, file=sys.stderr)
-    for x in e.__cause__.args[0]:
-        print(x, file=sys.stderr)
+    if args.serve:
+        server.serve(args.socket, serve_request)
+        return
+    if args.source_file is None:
+        arg_parser.error('the following arguments are required: source_file')
+    if args.use_server and not args.watch:
+        status = server.request(args.socket, sys.argv[1:])
+        if status is not None:
+            sys.exit(status)
+
+    import core
+
+    run(args)
+    if args.watch:
+        while True:
+            changed_modules = wait_for_changes(args.source_file)
+            print('Changed: {}'.format(', '.join(sorted(changed_modules))), file=sys.stderr)
+            core.forget()
+            try:
+                run(args)
+            except Exception as e:
+                print('{}: {}'.format(e.__class__.__name__, e), file=sys.stderr)
+
+
+def get_arg_parser():
+    arg_parser = argparse.ArgumentParser()
+
+    arg_parser.add_argument('source_file', nargs='?', help='(without extension)')
+    arg_parser.add_argument('--jobs', type=int, default=None,
+                            help='number of processes to parse out of date imported modules in (CPU count by default)')
+    arg_parser.add_argument('--parse-stats', action='store_true',
+                            help='print a summary of the parsing work to stderr, parsing in this process only')
+    arg_parser.add_argument('--compiled', action='store_true',
+                            help='run modules compiled to closures rather than by walking their syntax trees')
+    arg_parser.add_argument('--profile', action='store_true',
+                            help='print the functions, macros and nodes that took the most time to stderr, with the '
+                                 'lines of their sources')
+    arg_parser.add_argument('--watch', action='store_true',
+                            help='run again whenever the source or a module it imports changes, reparsing only the '
+                                 'modules affected')
+    arg_parser.add_argument('--serve', action='store_true',
+                            help='serve runs requested with --use-server, keeping the grammars and modules read in memory '
+                                 'between them')
+    arg_parser.add_argument('--use-server', action='store_true',
+                            help='run on the server listening on the socket, or in this process if there is none')
+    arg_parser.add_argument('--socket', default=server.get_default_socket_path(),
+                            help='socket of the server (%(default)s by default)')
+
+    return arg_parser
+
+
+def serve_request(argv):
+    """Run argv as a request to the server, as a process of its own would, but reading again only the modules whose
+    sources changed since the last request."""
+    import core
+
+    arg_parser = get_arg_parser()
+    args = arg_parser.parse_args(argv)
+    if args.source_file is None:
+        arg_parser.error('the following arguments are required: source_file')
+    if args.serve or args.watch:
+        arg_parser.error('--serve and --watch can\'t be requested from the server')
+
+    core.forget_changed()
+    # Modules run again, since running the source is what the request is for.
+    core.Module.cache_clear()
+    run(args)
+    return 0
+
+
+def run(args):
+    import core
+    import pearl
+
+    if args.parse_stats:
+        parse_stats = pearl.ParseStats()
+        core.collect_parse_stats(parse_stats)
+    elif args.jobs != 1:
+        core.preload(args.source_file, jobs=args.jobs)
+
+    if args.profile:
+        profile = core.Profile()
+        profile.enable()
+
+    try:
+        if args.compiled:
+            module = core.Module(args.source_file, compiled=True)
+        else:
+            module = core.Module(args.source_file)
+    except Exception as e:
+        if e.__cause__.__class__ != pearl.AmbiguousParse:
+            raise
+        print(e, file=sys.stderr)
+        for x in e.__cause__.args[0]:
+            print(x, file=sys.stderr)
+    finally:
+        if args.profile:
+            profile.disable()
+            print(profile.summary(), file=sys.stderr)
+        if args.parse_stats:
+            core.collect_parse_stats(None)
+            if parse_stats.parses == 0:
+                print('No modules were parsed, their .langc files were up to date', file=sys.stderr)
+            else:
+                print(parse_stats.summary(), file=sys.stderr)
+
+
+def wait_for_changes(module_path, interval=0.5):
+    """Poll the sources of module_path and the modules it imports until some change, and return the paths of those."""
+    import core
+
+    def get_mtimes(graph):
+        mtimes = {}
+        for m, file_path in graph.items():
+            try:
+                mtimes[m] = os.stat(file_path).st_mtime_ns
+            except OSError:
+                mtimes[m] = None
+        return mtimes
+
+    graph = core.get_module_graph(module_path)
+    mtimes = get_mtimes(graph)
+    while True:
+        time.sleep(interval)
+        new_mtimes = get_mtimes(graph)
+        changed_modules = {m for m in graph if new_mtimes[m] != mtimes[m]}
+        if changed_modules:
+            return changed_modules
+
+
+# Processes parsing modules for preload may import this module again, which must not run it.
+if __name__ == '__main__':
+    main()
@@ -1,24 +1,31 @@
 from functools import lru_cache as _lru_cache
 
-from ._read import read as _read
+from ._read import read as _read, _get_file_path
 from . import ast as _ast
+from . import _profile
 
 
 @_lru_cache(maxsize=None)
 class Module:
-    def __init__(self, path):
+    def __init__(self, path, *, compiled=False):
         self.__path = path
         self.__body = _read(path)
         self.__exported_variables = {}
+        if _profile.enabled_profile is not None:
+            _profile.enabled_profile.add_module(_get_file_path(path) + '.lang', self.__body)
         self.__exported_macro_definitions = {}
 
         context = _ast.Context()
 
-        self.__body.execute(context)
+        if compiled:
+            self.__body.compile()(context)
+        else:
+            self.__body.execute(context)
 
         for s in self.__body.statements:
             if s.__class__ == _ast.Import and s.exported:
-                module = Module(s.module_path)
+                # Called as the import was, since lru_cache tells Module(p) and Module(p, compiled=False) apart.
+                module = Module(s.module_path, compiled=True) if compiled else Module(s.module_path)
                 self.__exported_variables.update(module.__exported_variables)
                 self.__exported_macro_definitions.update(module.__exported_macro_definitions)
             if s.__class__ == _ast.VariableDeclaration and s.exported:
@@ -1,4 +1,5 @@
 from ._core_grammar import core_grammar
 from . import ast
-from ._read import read
+from ._read import read, collect_parse_stats, preload, get_module_graph, forget, forget_changed
 from ._Module import Module
+from ._profile import Profile
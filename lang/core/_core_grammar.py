@@ -1,31 +1,13 @@
 from functools import lru_cache as _lru_cache
+from hashlib import blake2b as _blake2b
+import os as _os
+import pickle as _pickle
+import re as _re
 import string as _string
 
 import pearl as _pearl
 from . import ast as _ast
-
-
-g = _pearl.Grammar()
-
-g = g.put('__start__', [{'statement_sequence'}, 'whitespace'])
-
-
-# statement sequence
-g = g.put('statement_sequence', [{'statements'}], _ast.StatementSequence)
-
-g = g.put('statements', [], lambda: ())
-g = g.put('statements', [{'statement'},
-                         {'statements'}], lambda first, rest: (first,) + rest)
-
-
-# unused expression
-g = g.put('statement', [{'expression'},
-                        'whitespace', ';'])
-
-
-# export
-g = g.put('export', [], lambda: False)
-g = g.put('export', ['whitespace', 'e', 'x', 'p', 'o', 'r', 't'], lambda: True)
+from ._files import get_cache_path as _get_cache_path, replace_file as _replace_file
 
 
 @_lru_cache(maxsize=256)
@@ -50,19 +32,24 @@ def _get_grammar_patch(module_path):
     return patch_grammar
 
 
-# import
-g = g.put('statements', [{'export'},
-                         'whitespace', 'i', 'm', 'p', 'o', 'r', 't',
-                         {'string'},
-                         'whitespace', ';', (lambda g, exported, module_path: _get_grammar_patch(module_path)(g)),
-                         {'statements'}], lambda exported, module_path, rest: (_ast.Import(exported, module_path),) + rest)
+def _get_imported_grammar(g, module_path):
+    from ._read import _get_imported_grammar
+    return _get_imported_grammar(g, module_path)
+
+
+# What the whitespace nonterminal matches by default: whitespace characters and comments. Nodes are placed after it.
+_WHITESPACE_PATTERN = _re.compile('(?:[{}]|#[{}]*\n)*'.format(_re.escape(_string.whitespace),
+                                                             _re.escape(_string.printable.replace('\n', ''))))
+
 
+def _locate(node, position):
+    """node, with the position of its source as the (line, column) pair position."""
+    node.position = position
+    return node
 
-# variable declaration
-g = g.put('statement', [{'export'},
-                        'whitespace', 'v', 'a', 'r',
-                        {'identifier'},
-                        'whitespace', ';'], _ast.VariableDeclaration)
+
+def _get_position(node, default=None):
+    return getattr(node, 'position', default)
 
 
 def _build_macro_body_symbols(parameters):
@@ -82,282 +69,431 @@ def _build_macro_body_symbols(parameters):
 
 
 def _add_macro_use_rule(g, head, body):
-    return g.put(head, _build_macro_body_symbols(body), lambda *nodes: _ast.MacroUse(head, body, nodes))
+    build_macro_use = lambda start, stop, *nodes: _locate(_ast.MacroUse(head, body, nodes), start)
+    return g.put(head, _build_macro_body_symbols(body), _pearl.located(build_macro_use, skip=_WHITESPACE_PATTERN))
 
 
-def _build_macro_transform(parameters, transform_body):
-    arguments = ['__usage_context__']
+def _build_macro_transform(parameters, transform_body, *, expansion=False):
+    # Expansions are given the nodes alone, since the node they expand to is kept for every later use.
+    arguments = [] if expansion else ['__usage_context__']
     for parameter in parameters:
         if parameter.__class__ == _ast.MacroParameterNonterminal and parameter.name is not None:
             arguments.append(parameter.name)
-    return _ast.FunctionLiteral(tuple(arguments), transform_body)
+    # Macro definitions aren't placed, since positions would make every one a different grammar transform, so their
+    # transforms are placed at their first statement.
+    position = _get_position(transform_body.statements[0]) if transform_body.statements else None
+    return _locate(_ast.FunctionLiteral(tuple(arguments), transform_body), position)
 
 
-# macro definition
-g = g.put('statements', [{'export'},
-                         'whitespace', 'm', 'a', 'c', 'r', 'o',
-                         {'identifier'},
-                         'whitespace', '-', '>',
-                         {'macro_parameters'},
-                         'whitespace', '{',
-                         {'statement_sequence'},
-                         'whitespace', '}', (lambda g, exported, head, body, _: _add_macro_use_rule(g, head, body)),
-                         {'statements'}], lambda exported, head, body, transform_body, rest: (_ast.MacroDefinition(exported, head, body, _build_macro_transform(body, transform_body)),) + rest)
+def _drop_unmacro_rule(g, head, body):
+    return g.drop(head, _build_macro_body_symbols(body))
 
-g = g.put('macro_parameters', [], lambda: ())
-g = g.put('macro_parameters', [{'macro_parameter'}], lambda parameter: (parameter,))
-g = g.put('macro_parameters', [{'macro_parameter'},
-                               'whitespace', ',',
-                               {'macro_parameters'}], lambda first, rest: (first,) + rest)
 
-g = g.put('macro_parameter', [{'string'}], lambda symbols: _ast.MacroParameterTerminal(tuple(symbols)))
-g = g.put('macro_parameter', [{'identifier'},
-                              {'macro_parameter_nonterminal_name'}], _ast.MacroParameterNonterminal)
+def parse_string(text):
+    return text[1:-1]. \
+        replace('\\\\', '\\'). \
+        replace('\\\'', '\''). \
+        replace('\\\t', '\t'). \
+        replace('\\\v', '\v'). \
+        replace('\\\f', '\f'). \
+        replace('\\\n', '\n'). \
+        replace('\\\r', '\r')
 
-g = g.put('macro_parameter_nonterminal_name', [], lambda: None)
-g = g.put('macro_parameter_nonterminal_name', ['whitespace', '/',
-                                               {'identifier'}])
 
+# Build results and grammar transforms of the rules, registered so that the dump of core_grammar can refer to them.
+_build_empty = _pearl.register_action('core.build_empty', lambda: ())
+_build_single = _pearl.register_action('core.build_single', lambda first: (first,))
+_build_prepended = _pearl.register_action('core.build_prepended', lambda first, rest: (first,) + rest)
+_build_false = _pearl.register_action('core.build_false', lambda: False)
+_build_true = _pearl.register_action('core.build_true', lambda: True)
+_build_none = _pearl.register_action('core.build_none', lambda: None)
+
+_import_grammar = _pearl.register_action(
+    'core.import_grammar', lambda g, exported, module_path: _get_imported_grammar(g, module_path))
+_build_import = _pearl.register_action(
+    'core.build_import', lambda exported, module_path, rest: (_ast.Import(exported, module_path),) + rest)
+
+_define_macro_grammar = _pearl.register_action(
+    'core.define_macro_grammar', lambda g, exported, head, body, _: _add_macro_use_rule(g, head, body))
+_build_macro_definition = _pearl.register_action(
+    'core.build_macro_definition',
+    lambda exported, head, body, transform_body, rest:
+        (_ast.MacroDefinition(exported, head, body, _build_macro_transform(body, transform_body)),) + rest)
+_build_expansion_definition = _pearl.register_action(
+    'core.build_expansion_definition',
+    lambda exported, head, body, transform_body, rest:
+        (_ast.MacroDefinition(exported, head, body, _build_macro_transform(body, transform_body, expansion=True), True),) + rest)
+_undefine_macro_grammar = _pearl.register_action(
+    'core.undefine_macro_grammar', lambda g, exported, head, body: _drop_unmacro_rule(g, head, body))
+_build_macro_undefinition = _pearl.register_action(
+    'core.build_macro_undefinition',
+    lambda exported, head, body, rest: (_ast.MacroUndefinition(exported, head, body),) + rest)
+
+_build_terminal_parameter = _pearl.register_action(
+    'core.build_terminal_parameter', lambda symbols: _ast.MacroParameterTerminal(tuple(symbols)))
+_build_unnamed_nonterminal_parameter = _pearl.register_action(
+    'core.build_unnamed_nonterminal_parameter', lambda symbol: _ast.MacroParameterNonterminal(symbol, None))
+
+_pearl.register_action('core.parse_string', parse_string)
+
+def _register_node_builder(name, node_class):
+    """Register the build result of node_class, placed at the start of its source after the whitespace before it."""
+    build_node = lambda start, stop, *fields: _locate(node_class(*fields), start)
+    return _pearl.register_action(name, _pearl.located(build_node, skip=_WHITESPACE_PATTERN))
+
+
+_build_variable_declaration = _register_node_builder('core.build_variable_declaration', _ast.VariableDeclaration)
+_build_block = _register_node_builder('core.build_block', _ast.Block)
+_build_if = _register_node_builder('core.build_if', _ast.If)
+_build_forever = _register_node_builder('core.build_forever', _ast.Forever)
+_build_continue = _register_node_builder('core.build_continue', _ast.Continue)
+_build_break = _register_node_builder('core.build_break', _ast.Break)
+_build_return = _register_node_builder('core.build_return', _ast.Return)
+_build_variable_assignment = _register_node_builder('core.build_variable_assignment', _ast.VariableAssignment)
+_build_attribute_assignment = _register_node_builder('core.build_attribute_assignment', _ast.AttributeAssignment)
+_build_attribute_access = _register_node_builder('core.build_attribute_access', _ast.AttributeAccess)
+_build_call = _register_node_builder('core.build_call', _ast.Call)
+_build_variable_access = _register_node_builder('core.build_variable_access', _ast.VariableAccess)
+_build_number_literal = _register_node_builder('core.build_number_literal', _ast.NumberLiteral)
+_build_string_literal = _register_node_builder('core.build_string_literal', _ast.StringLiteral)
+_build_function_literal = _register_node_builder('core.build_function_literal', _ast.FunctionLiteral)
+
+
+def _build_core_grammar():
+    g = _pearl.Grammar()
+
+    g = g.put('__start__', [{'statement_sequence'}, 'whitespace'])
+
+
+    # statement sequence
+    g = g.put('statement_sequence', [{'statements'}], _ast.StatementSequence)
+
+    g = g.put('statements', [], _build_empty)
+    g = g.put('statements', [{'statement'},
+                             {'statements'}], _build_prepended)
+
+
+    # unused expression
+    g = g.put('statement', [{'expression'},
+                            'whitespace', ';'])
+
+
+    # export
+    g = g.put('export', [], _build_false)
+    g = g.put('export', ['whitespace', 'e', 'x', 'p', 'o', 'r', 't'], _build_true)
+
+
+    # import
+    g = g.put('statements', [{'export'},
+                             'whitespace', 'i', 'm', 'p', 'o', 'r', 't',
+                             {'string'},
+                             'whitespace', ';', _import_grammar,
+                             {'statements'}], _build_import)
+
+
+    # variable declaration
+    g = g.put('statement', [{'export'},
+                            'whitespace', 'v', 'a', 'r',
+                            {'identifier'},
+                            'whitespace', ';'], _build_variable_declaration)
+
+
+    # macro definition
+    g = g.put('statements', [{'export'},
+                             'whitespace', 'm', 'a', 'c', 'r', 'o',
+                             {'identifier'},
+                             'whitespace', '-', '>',
+                             {'macro_parameters'},
+                             'whitespace', '{',
+                             {'statement_sequence'},
+                             'whitespace', '}', _define_macro_grammar,
+                             {'statements'}], _build_macro_definition)
+
+    # expansion macro definition
+    g = g.put('statements', [{'export'},
+                             'whitespace', 'e', 'x', 'p', 'a', 'n', 's', 'i', 'o', 'n',
+                             {'identifier'},
+                             'whitespace', '-', '>',
+                             {'macro_parameters'},
+                             'whitespace', '{',
+                             {'statement_sequence'},
+                             'whitespace', '}', _define_macro_grammar,
+                             {'statements'}], _build_expansion_definition)
+
+    g = g.put('macro_parameters', [], _build_empty)
+    g = g.put('macro_parameters', [{'macro_parameter'}], _build_single)
+    g = g.put('macro_parameters', [{'macro_parameter'},
+                                   'whitespace', ',',
+                                   {'macro_parameters'}], _build_prepended)
+
+    g = g.put('macro_parameter', [{'string'}], _build_terminal_parameter)
+    g = g.put('macro_parameter', [{'identifier'},
+                                  {'macro_parameter_nonterminal_name'}], _ast.MacroParameterNonterminal)
+
+    g = g.put('macro_parameter_nonterminal_name', [], _build_none)
+    g = g.put('macro_parameter_nonterminal_name', ['whitespace', '/',
+                                                   {'identifier'}])
 
-def _drop_unmacro_rule(g, head, body):
-    return g.drop(head, _build_macro_body_symbols(body))
 
-# unmacro
-g = g.put('statements', [{'export'},
-                         'whitespace', 'u', 'n', 'm', 'a', 'c', 'r', 'o',
-                         {'identifier'},
-                         'whitespace', '-', '>',
-                         {'unmacro_parameters'},
-                         'whitespace', ';', (lambda g, exported, head, body: _drop_unmacro_rule(g, head, body)),
-                         {'statements'}], lambda exported, head, body, rest: (_ast.MacroUndefinition(exported, head, body),) + rest)
-
-g = g.put('unmacro_parameters', [], lambda: ())
-g = g.put('unmacro_parameters', [{'unmacro_parameter'}], lambda parameter: (parameter,))
-g = g.put('unmacro_parameters', [{'unmacro_parameter'},
-                                  'whitespace', ',',
-                                 {'unmacro_parameters'}], lambda first, rest: (first,) + rest)
-
-g = g.put('unmacro_parameter', [{'string'}], lambda symbols: _ast.MacroParameterTerminal(tuple(symbols)))
-g = g.put('unmacro_parameter', [{'identifier'}], lambda symbol: _ast.MacroParameterNonterminal(symbol, None))
-
-
-# block
-g = g.put('statement', [{'block'}])
-g = g.put('block', ['whitespace', '{',
-                    {'statement_sequence'},
-                    'whitespace', '}'], _ast.Block)
-
-# if
-g = g.put('statement', [{'if'}])
-
-g = g.put('if', ['whitespace', 'i', 'f',
-                 {'expression'},
-                 {'block'},
-                 {'if_else'}], _ast.If)
-
-g = g.put('if_else', ['whitespace', 'e', 'l', 's', 'e',
-                      {'block'}])
-
-# forever
-g = g.put('statement', [{'forever'}])
-g = g.put('forever', ['whitespace', 'f', 'o', 'r', 'e', 'v', 'e', 'r',
-                      {'block'}], _ast.Forever)
-
-# continue
-g = g.put('statement', [{'continue'}])
-g = g.put('continue', ['whitespace', 'c', 'o', 'n', 't', 'i', 'n', 'u', 'e',
-                       'whitespace', ';'], _ast.Continue)
-
-# break
-g = g.put('statement', [{'break'}])
-g = g.put('break', ['whitespace', 'b', 'r', 'e', 'a', 'k',
-                    'whitespace', ';'], _ast.Break)
-
-# return
-g = g.put('statement', [{'return'}])
-g = g.put('return', ['whitespace', 'r', 'e', 't', 'u', 'r', 'n',
+    # unmacro
+    g = g.put('statements', [{'export'},
+                             'whitespace', 'u', 'n', 'm', 'a', 'c', 'r', 'o',
+                             {'identifier'},
+                             'whitespace', '-', '>',
+                             {'unmacro_parameters'},
+                             'whitespace', ';', _undefine_macro_grammar,
+                             {'statements'}], _build_macro_undefinition)
+
+    g = g.put('unmacro_parameters', [], _build_empty)
+    g = g.put('unmacro_parameters', [{'unmacro_parameter'}], _build_single)
+    g = g.put('unmacro_parameters', [{'unmacro_parameter'},
+                                      'whitespace', ',',
+                                     {'unmacro_parameters'}], _build_prepended)
+
+    g = g.put('unmacro_parameter', [{'string'}], _build_terminal_parameter)
+    g = g.put('unmacro_parameter', [{'identifier'}], _build_unnamed_nonterminal_parameter)
+
+
+    # block
+    g = g.put('statement', [{'block'}])
+    g = g.put('block', ['whitespace', '{',
+                        {'statement_sequence'},
+                        'whitespace', '}'], _build_block)
+
+    # if
+    g = g.put('statement', [{'if'}])
+
+    g = g.put('if', ['whitespace', 'i', 'f',
                      {'expression'},
-                     'whitespace', ';'], _ast.Return)
-
-# variable assignment
-g = g.put('statement', [{'variable_assignment'}])
-g = g.put('variable_assignment', [{'identifier'},
-                                   'whitespace', '=',
-                                   {'expression'},
-                                   'whitespace', ';'], _ast.VariableAssignment)
-
-# attribute assignment
-g = g.put('statement', [{'attribute_assignment'}])
-g = g.put('attribute_assignment', [{'postfix_expression'},
+                     {'block'},
+                     {'if_else'}], _build_if)
+
+    g = g.put('if_else', ['whitespace', 'e', 'l', 's', 'e',
+                          {'block'}])
+
+    # forever
+    g = g.put('statement', [{'forever'}])
+    g = g.put('forever', ['whitespace', 'f', 'o', 'r', 'e', 'v', 'e', 'r',
+                          {'block'}], _build_forever)
+
+    # continue
+    g = g.put('statement', [{'continue'}])
+    g = g.put('continue', ['whitespace', 'c', 'o', 'n', 't', 'i', 'n', 'u', 'e',
+                           'whitespace', ';'], _build_continue)
+
+    # break
+    g = g.put('statement', [{'break'}])
+    g = g.put('break', ['whitespace', 'b', 'r', 'e', 'a', 'k',
+                        'whitespace', ';'], _build_break)
+
+    # return
+    g = g.put('statement', [{'return'}])
+    g = g.put('return', ['whitespace', 'r', 'e', 't', 'u', 'r', 'n',
+                         {'expression'},
+                         'whitespace', ';'], _build_return)
+
+    # variable assignment
+    g = g.put('statement', [{'variable_assignment'}])
+    g = g.put('variable_assignment', [{'identifier'},
+                                       'whitespace', '=',
+                                       {'expression'},
+                                       'whitespace', ';'], _build_variable_assignment)
+
+    # attribute assignment
+    g = g.put('statement', [{'attribute_assignment'}])
+    g = g.put('attribute_assignment', [{'postfix_expression'},
+                                       'whitespace', '.',
+                                       {'identifier'},
+                                       'whitespace', '=',
+                                       {'expression'},
+                                       'whitespace', ';'], _build_attribute_assignment)
+
+
+    g = g.put('expression', [{'postfix_expression'}])
+
+
+    # attribute access
+    g = g.put('postfix_expression', [{'attribute_access'}])
+    g = g.put('attribute_access', [{'postfix_expression'},
                                    'whitespace', '.',
-                                   {'identifier'},
-                                   'whitespace', '=',
-                                   {'expression'},
-                                   'whitespace', ';'], _ast.AttributeAssignment)
+                                   {'identifier'}], _build_attribute_access)
 
+    # call
+    g = g.put('postfix_expression', [{'call'}])
+    g = g.put('call', [{'postfix_expression'},
+                       'whitespace', '(',
+                       {'call_arguments'},
+                       'whitespace', ')'], _build_call)
 
-g = g.put('expression', [{'postfix_expression'}])
+    g = g.put('call_arguments', [], _build_empty)
+    g = g.put('call_arguments', [{'expression'}], _build_single)
+    g = g.put('call_arguments', [{'expression'},
+                                 'whitespace', ',',
+                                 {'call_arguments'}], _build_prepended)
 
 
-# attribute access
-g = g.put('postfix_expression', [{'attribute_access'}])
-g = g.put('attribute_access', [{'postfix_expression'},
-                               'whitespace', '.',
-                               {'identifier'}], _ast.AttributeAccess)
+    g = g.put('postfix_expression', [{'primary_expression'}])
 
-# call
-g = g.put('postfix_expression', [{'call'}])
-g = g.put('call', [{'postfix_expression'},
-                   'whitespace', '(',
-                   {'call_arguments'},
-                   'whitespace', ')'], _ast.Call)
 
-g = g.put('call_arguments', [], lambda: ())
-g = g.put('call_arguments', [{'expression'}], lambda argument: (argument,))
-g = g.put('call_arguments', [{'expression'},
-                             'whitespace', ',',
-                             {'call_arguments'}], lambda argument, rest: (argument,) + rest)
+    # variable access
+    g = g.put('primary_expression', [{'variable_access'}])
+    g = g.put('variable_access', [{'identifier'}], _build_variable_access)
 
+    # number literal
+    g = g.put('primary_expression', [{'number_literal'}])
+    g = g.put('number_literal', [{'number'}], _build_number_literal)
 
-g = g.put('postfix_expression', [{'primary_expression'}])
+    # string literal
+    g = g.put('primary_expression', [{'string_literal'}])
+    g = g.put('string_literal', [{'string'}], _build_string_literal)
 
+    # function literal
+    g = g.put('primary_expression', [{'function_literal'}])
+    g = g.put('function_literal', ['whitespace', '(',
+                                   {'function_literal_parameters'},
+                                   'whitespace', ')',
+                                   'whitespace', '=', '>',
+                                   'whitespace', '{',
+                                   {'statement_sequence'},
+                                   'whitespace', '}'], _build_function_literal)
 
-# variable access
-g = g.put('primary_expression', [{'variable_access'}])
-g = g.put('variable_access', [{'identifier'}], _ast.VariableAccess)
+    g = g.put('function_literal_parameters', [], _build_empty)
+    g = g.put('function_literal_parameters', [{'identifier'}], _build_single)
+    g = g.put('function_literal_parameters', [{'identifier'},
+                                              'whitespace', ',',
+                                              {'function_literal_parameters'}], _build_prepended)
 
-# number literal
-g = g.put('primary_expression', [{'number_literal'}])
-g = g.put('number_literal', [{'number'}], _ast.NumberLiteral)
+    # parenthesized expression
+    g = g.put('primary_expression', [{'parenthesized_expression'}])
+    g = g.put('parenthesized_expression', ['whitespace', '(',
+                                           {'expression'},
+                                           'whitespace', ')'])
 
-# string literal
-g = g.put('primary_expression', [{'string_literal'}])
-g = g.put('string_literal', [{'string'}], _ast.StringLiteral)
 
-# function literal
-g = g.put('primary_expression', [{'function_literal'}])
-g = g.put('function_literal', ['whitespace', '(',
-                               {'function_literal_parameters'},
-                               'whitespace', ')',
-                               'whitespace', '=', '>',
-                               'whitespace', '{',
-                               {'statement_sequence'},
-                               'whitespace', '}'], _ast.FunctionLiteral)
+    g = g.put('string', ['whitespace', {'string_without_whitespace'}], parse_string)
 
-g = g.put('function_literal_parameters', [], lambda: ())
-g = g.put('function_literal_parameters', [{'identifier'}], lambda parameter: (parameter,))
-g = g.put('function_literal_parameters', [{'identifier'},
-                                          'whitespace', ',',
-                                          {'function_literal_parameters'}], lambda first, rest: (first,) + rest)
+    g = g.put('string_without_whitespace', ['\'', 'string_items', '\''])
 
-# parenthesized expression
-g = g.put('primary_expression', [{'parenthesized_expression'}])
-g = g.put('parenthesized_expression', ['whitespace', '(',
-                                       {'expression'},
-                                       'whitespace', ')'])
+    g = g.put('string_items', [])
+    g = g.put('string_items', ['string_item', 'string_items'])
 
+    g = g.put('string_item', ['letter'])
+    g = g.put('string_item', ['digit'])
+    g = g.put('string_item', ['punctuation_without_backslash_and_quote'])
+    g = g.put('string_item', ['\\', '\\'])
+    g = g.put('string_item', ['\\', '\''])
+    g = g.put('string_item', ['whitespace_char'])
+    g = g.put('string_item', ['\\', 't'])
+    g = g.put('string_item', ['\\', 'v'])
+    g = g.put('string_item', ['\\', 'f'])
+    g = g.put('string_item', ['\\', 'n'])
+    g = g.put('string_item', ['\\', 'r'])
 
-def parse_string(text):
-    return text[1:-1]. \
-        replace('\\\\', '\\'). \
-        replace('\\\'', '\''). \
-        replace('\\\t', '\t'). \
-        replace('\\\v', '\v'). \
-        replace('\\\f', '\f'). \
-        replace('\\\n', '\n'). \
-        replace('\\\r', '\r')
 
-g = g.put('string', ['whitespace', {'string_without_whitespace'}], parse_string)
+    g = g.put('number', ['whitespace', {'number_without_whitespace'}], float)
+
+    g = g.put('number_without_whitespace', ['number_sign_opt',
+                                            'number_integer',
+                                            'number_fraction_opt',
+                                            'number_exponent_opt'])
+
+    g = g.put('number_sign_opt', [])
+    g = g.put('number_sign_opt', ['+'])
+    g = g.put('number_sign_opt', ['-'])
+
+    g = g.put('number_integer', ['digit'])
+    g = g.put('number_integer', ['digit', 'number_integer'])
+
+    g = g.put('number_fraction_opt', [])
+    g = g.put('number_fraction_opt', ['.', 'number_integer'])
+
+    g = g.put('number_exponent_opt', [])
+    g = g.put('number_exponent_opt', ['e', 'number_sign_opt', 'number_integer'])
+    g = g.put('number_exponent_opt', ['E', 'number_sign_opt', 'number_integer'])
 
-g = g.put('string_without_whitespace', ['\'', 'string_items', '\''])
 
-g = g.put('string_items', [])
-g = g.put('string_items', ['string_item', 'string_items'])
+    g = g.put('identifier', ['whitespace', {'identifier_without_whitespace'}])
 
-g = g.put('string_item', ['letter'])
-g = g.put('string_item', ['digit'])
-g = g.put('string_item', ['punctuation_without_backslash_and_quote'])
-g = g.put('string_item', ['\\', '\\'])
-g = g.put('string_item', ['\\', '\''])
-g = g.put('string_item', ['whitespace_char'])
-g = g.put('string_item', ['\\', 't'])
-g = g.put('string_item', ['\\', 'v'])
-g = g.put('string_item', ['\\', 'f'])
-g = g.put('string_item', ['\\', 'n'])
-g = g.put('string_item', ['\\', 'r'])
+    g = g.put('identifier_without_whitespace', ['identifier_head',
+                                                'identifier_tail'])
 
+    g = g.put('identifier_head', ['_'])
+    g = g.put('identifier_head', ['letter'])
 
-g = g.put('number', ['whitespace', {'number_without_whitespace'}], float)
+    g = g.put('identifier_tail', [])
+    g = g.put('identifier_tail', ['_', 'identifier_tail'])
+    g = g.put('identifier_tail', ['letter', 'identifier_tail'])
+    g = g.put('identifier_tail', ['digit', 'identifier_tail'])
 
-g = g.put('number_without_whitespace', ['number_sign_opt',
-                                        'number_integer',
-                                        'number_fraction_opt',
-                                        'number_exponent_opt'])
 
-g = g.put('number_sign_opt', [])
-g = g.put('number_sign_opt', ['+'])
-g = g.put('number_sign_opt', ['-'])
+    # comment
+    g = g.put('whitespace', ['#', 'comment_chars', '\n', 'whitespace'])
 
-g = g.put('number_integer', ['digit'])
-g = g.put('number_integer', ['digit', 'number_integer'])
+    g = g.put('comment_chars', [])
+    g = g.put('comment_chars', ['comment_char', 'comment_chars'])
 
-g = g.put('number_fraction_opt', [])
-g = g.put('number_fraction_opt', ['.', 'number_integer'])
+    g = g.put('comment_char', ['letter'])
+    g = g.put('comment_char', ['digit'])
+    g = g.put('comment_char', ['punctuation'])
+    g = g.put('comment_char', ['whitespace_char_without_newline'])
 
-g = g.put('number_exponent_opt', [])
-g = g.put('number_exponent_opt', ['e', 'number_sign_opt', 'number_integer'])
-g = g.put('number_exponent_opt', ['E', 'number_sign_opt', 'number_integer'])
 
+    g = g.put('letter', [_pearl.CharacterClass(_string.ascii_letters)])
 
-g = g.put('identifier', ['whitespace', {'identifier_without_whitespace'}])
+    g = g.put('digit', [_pearl.CharacterClass(_string.digits)])
 
-g = g.put('identifier_without_whitespace', ['identifier_head',
-                                            'identifier_tail'])
+    g = g.put('punctuation_without_backslash_and_quote', [_pearl.CharacterClass(_string.punctuation.replace('\\', '').replace('\'', ''))])
+    g = g.put('punctuation', ['punctuation_without_backslash_and_quote'])
+    g = g.put('punctuation', ['\\'])
+    g = g.put('punctuation', ['\''])
 
-g = g.put('identifier_head', ['_'])
-g = g.put('identifier_head', ['letter'])
+    g = g.put('whitespace_without_newline', [])
+    g = g.put('whitespace_without_newline', ['whitespace_char_without_newline', 'whitespace_without_newline'])
+    g = g.put('whitespace_char_without_newline', [_pearl.CharacterClass(_string.whitespace.replace('\n', ''))])
+    g = g.put('whitespace', [])
+    g = g.put('whitespace', ['whitespace_char', 'whitespace'])
+    g = g.put('whitespace_char', ['whitespace_char_without_newline'])
+    g = g.put('whitespace_char', ['\n'])
 
-g = g.put('identifier_tail', [])
-g = g.put('identifier_tail', ['_', 'identifier_tail'])
-g = g.put('identifier_tail', ['letter', 'identifier_tail'])
-g = g.put('identifier_tail', ['digit', 'identifier_tail'])
+    return g
 
 
-# comment
-g = g.put('whitespace', ['#', 'comment_chars', '\n', 'whitespace'])
+def _get_core_grammar_digest():
+    """Digest of the sources core_grammar is built from, and whose classes and actions its dump refers to. The dump is
+    rebuilt on changes of any of them."""
+    digest = _blake2b(digest_size=16)
+    for source_path in (__file__, _pearl.__file__, _ast.__file__):
+        with open(source_path, 'rb') as source_file:
+            digest.update(_blake2b(source_file.read(), digest_size=16).digest())
+    return digest.digest()
 
-g = g.put('comment_chars', [])
-g = g.put('comment_chars', ['comment_char', 'comment_chars'])
 
-g = g.put('comment_char', ['letter'])
-g = g.put('comment_char', ['digit'])
-g = g.put('comment_char', ['punctuation'])
-g = g.put('comment_char', ['whitespace_char_without_newline'])
+def _load_core_grammar():
+    """core_grammar loaded from its dump, or built and dumped if the dump is missing or out of date."""
+    path = _get_cache_path('core_grammar.pearl')
+    digest = _get_core_grammar_digest()
 
+    try:
+        with open(path, 'rb') as dump_file:
+            if _pickle.load(dump_file) == digest:
+                return _pearl.Grammar.load(dump_file)
+    except (IOError, EOFError, ValueError, AttributeError, ImportError, _pickle.UnpicklingError):
+        pass
 
-for c in _string.ascii_letters:
-    g = g.put('letter', [c])
+    g = _build_core_grammar()
 
-for c in _string.digits:
-    g = g.put('digit', [c])
+    def write(dump_file):
+        _pickle.dump(digest, dump_file)
+        g.dump(dump_file)
 
-for c in _string.punctuation:
-    if c not in '\\\'':
-        g = g.put('punctuation_without_backslash_and_quote', [c])
-g = g.put('punctuation', ['punctuation_without_backslash_and_quote'])
-g = g.put('punctuation', ['\\'])
-g = g.put('punctuation', ['\''])
+    try:
+        _os.makedirs(_os.path.dirname(path), exist_ok=True)
+        _replace_file(path, write)
+    except IOError:
+        # Such as where there is no writable home directory; core_grammar is then built by every process.
+        pass
 
-g = g.put('whitespace_without_newline', [])
-g = g.put('whitespace_without_newline', ['whitespace_char_without_newline', 'whitespace_without_newline'])
-for c in _string.whitespace:
-    if c != '\n':
-        g = g.put('whitespace_char_without_newline', [c])
-g = g.put('whitespace', [])
-g = g.put('whitespace', ['whitespace_char', 'whitespace'])
-g = g.put('whitespace_char', ['whitespace_char_without_newline'])
-g = g.put('whitespace_char', ['\n'])
+    return g
 
-core_grammar = g
 
-del g
+core_grammar = _load_core_grammar()
@@ -0,0 +1,23 @@
+import contextlib as _contextlib
+import os as _os
+
+
+def replace_file(path, write):
+    """Call write with a file opened for writing bytes, then move the file into place at path. It is written aside, under
+    the process id, so that other processes never read it partly written."""
+    temporary_path = '{}.{}'.format(path, _os.getpid())
+    try:
+        with open(temporary_path, 'wb') as file:
+            write(file)
+        _os.replace(temporary_path, path)
+    except BaseException:
+        with _contextlib.suppress(OSError):
+            _os.remove(temporary_path)
+        raise
+
+
+def get_cache_path(name):
+    """Path of the cache file name in the cache directory of the user, rather than beside the sources or in the working
+    directory, which may not be writable and are shared by every user."""
+    cache_directory = _os.environ.get('XDG_CACHE_HOME') or _os.path.join(_os.path.expanduser('~'), '.cache')
+    return _os.path.join(cache_directory, 'lang', name)
@@ -0,0 +1,231 @@
+import functools as _functools
+import time as _time
+
+from . import ast as _ast
+
+
+# The profile enabled at the moment, which the modules run register their bodies with.
+enabled_profile = None
+
+
+class _Entry:
+    __slots__ = ['subject', 'description', 'location', 'calls', 'seconds', 'depth']
+
+    def __init__(self, subject, description, location):
+        self.subject = subject
+        self.description = description
+        self.location = location
+        self.calls = 0
+        self.seconds = 0.0
+        self.depth = 0
+
+
+class Profile:
+    """Call counts and cumulative times of the nodes, the functions and the macros run while the profile is enabled,
+    from enable to disable, or within with profile: ...
+
+    Functions are told apart by the function literals they were made from, and macros by the rules of their uses. The
+    time of recursive runs is only counted once, for the outermost one. Entries are located at the file and the
+    position of their source, or of the closest node enclosing them that has one, such as the uses of macros for the
+    nodes they expand to.
+
+    The node classes of core.ast are instrumented while the profile is enabled, so code that isn't profiled runs at
+    full speed. Code compiled while the profile is enabled stops counting once it is disabled, but keeps running
+    through the instrumentation.
+    """
+
+    def __init__(self):
+        self.__node_entries = {}
+        self.__function_entries = {}
+        self.__macro_entries = {}
+        # Locations of the nodes of the modules run, keyed by id and holding on to the nodes so that their ids aren't
+        # reused.
+        self.__locations = {}
+        self.__stack = []
+        self.__enabled = False
+        self.__original_methods = {}
+        self.__start = None
+        self.seconds = 0.0
+
+    def __enter__(self):
+        self.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.disable()
+
+    def enable(self):
+        global enabled_profile
+        assert enabled_profile is None, 'Another profile is enabled'
+        enabled_profile = self
+        self.__enabled = True
+        for node_class in _ast._node_classes:
+            for name in ('execute', '_execute', 'compile', '_compile'):
+                method = node_class.__dict__.get(name)
+                if method is not None:
+                    self.__original_methods[node_class, name] = method
+                    setattr(node_class, name, self.__instrument(node_class, name, method))
+        # Nodes compiled before, or after, run as compiled then.
+        _ast._forget_compiled_nodes()
+        self.__start = _time.perf_counter()
+
+    def disable(self):
+        global enabled_profile
+        assert enabled_profile is self
+        self.seconds += _time.perf_counter() - self.__start
+        for (node_class, name), method in self.__original_methods.items():
+            setattr(node_class, name, method)
+        self.__original_methods.clear()
+        _ast._forget_compiled_nodes()
+        self.__enabled = False
+        enabled_profile = None
+
+    def add_module(self, file_path, body):
+        """Locate the nodes of body, the body of the module read from file_path."""
+        nodes = [(body, None)]
+        while nodes:
+            node, position = nodes.pop()
+            position = getattr(node, 'position', None) or position
+            location = (file_path,) if position is None else (file_path,) + position
+            self.__locations.setdefault(id(node), (node, location))
+            for field in node:
+                for child in (field if field.__class__ == tuple else (field,)):
+                    if child.__class__ in _ast._node_classes:
+                        nodes.append((child, position))
+
+    @property
+    def nodes(self):
+        """Entries of the nodes run, with the most cumulative time first. Each has a subject, the node, a description,
+        a location, (file_path, line, column), (file_path,) or None if unknown, the number of calls and the seconds."""
+        return _sorted_entries(self.__node_entries)
+
+    @property
+    def functions(self):
+        """Entries of the functions called, like nodes, whose subjects are the function literals they were made from."""
+        return _sorted_entries(self.__function_entries)
+
+    @property
+    def macros(self):
+        """Entries of the macros used, like nodes, whose subjects are the rules of their uses, which aren't located."""
+        return _sorted_entries(self.__macro_entries)
+
+    def summary(self, entry_count=10):
+        """Human readable report, listing the entry_count functions, macros and nodes with the most cumulative time. Of
+        the nodes at the same position, such as an operand and the uses of the operator macros wrapping it, only the one
+        with the most time is listed."""
+        nodes = []
+        locations = set()
+        for entry in self.nodes:
+            if entry.location is None or entry.location not in locations:
+                locations.add(entry.location)
+                nodes.append(entry)
+        lines = ['{:.3f} s profiled'.format(self.seconds)]
+        for kind, entries in [('functions', self.functions), ('macros', self.macros), ('nodes', nodes)]:
+            if entries:
+                lines.append('{} with the most time:'.format(kind))
+                for entry in entries[:entry_count]:
+                    lines.append('{:>10}  {:9.4f} s  {}'.format(entry.calls, entry.seconds, entry.description))
+                    if entry.location is not None:
+                        lines[-1] += '  at {}'.format(':'.join(map(str, entry.location)))
+        return '\n'.join(lines)
+
+    def __instrument(self, node_class, name, method):
+        if name in ('execute', '_execute'):
+            if node_class == _ast.FunctionLiteral:
+                def execute(node, context):
+                    return self.__profile_function(node, self.__run_node(node, method, node, context))
+            else:
+                def execute(node, context):
+                    return self.__run_node(node, method, node, context)
+
+            return execute
+
+        if node_class == _ast.FunctionLiteral:
+            def compile(node, scope=None):
+                run = method(node, scope)
+                return lambda context: self.__profile_function(node, self.__run_node(node, run, context))
+        else:
+            def compile(node, scope=None):
+                run = method(node, scope)
+                return lambda context: self.__run_node(node, run, context)
+
+        return compile
+
+    def __run_node(self, node, run, *arguments):
+        if not self.__enabled:
+            return run(*arguments)
+        entry = self.__node_entries.get(id(node))
+        if entry is None:
+            entry = self.__node_entries[id(node)] = _Entry(node, _describe_node(node), self.__locate(node))
+        # Such as execute running _execute, or the compiled forms of a node wrapping one another.
+        if self.__stack and self.__stack[-1] is entry:
+            return run(*arguments)
+        if node.__class__ == _ast.MacroUse:
+            rule = node.nonterminal, node.parameters
+            macro_entry = self.__macro_entries.get(rule)
+            if macro_entry is None:
+                macro_entry = self.__macro_entries[rule] = _Entry(rule, _describe_rule(rule), None)
+            return self.__measure(macro_entry, self.__measure, entry, run, *arguments)
+        return self.__measure(entry, run, *arguments)
+
+    def __profile_function(self, literal, value):
+        if not self.__enabled:
+            return value
+        entry = self.__function_entries.get(id(literal))
+        if entry is None:
+            entry = self.__function_entries[id(literal)] = _Entry(
+                literal, '({}) => {{...}}'.format(', '.join(literal.parameters)), self.__node_entries[id(literal)].location)
+
+        @_functools.wraps(value)
+        def profiled_value(*arguments):
+            if not self.__enabled:
+                return value(*arguments)
+            return self.__measure(entry, value, *arguments)
+
+        return profiled_value
+
+    def __locate(self, node):
+        try:
+            return self.__locations[id(node)][1]
+        except KeyError:
+            pass
+        # Nodes made as the program runs, such as by macros.
+        return self.__stack[-1].location if self.__stack else None
+
+    def __measure(self, entry, run, *arguments):
+        entry.calls += 1
+        entry.depth += 1
+        self.__stack.append(entry)
+        start = _time.perf_counter()
+        try:
+            return run(*arguments)
+        finally:
+            self.__stack.pop()
+            entry.depth -= 1
+            if entry.depth == 0:
+                entry.seconds += _time.perf_counter() - start
+
+
+def _sorted_entries(entries):
+    return sorted(entries.values(), key=lambda e: e.seconds, reverse=True)
+
+
+def _describe_node(node):
+    for field in ('nonterminal', 'name', 'attribute_name', 'method_name'):
+        value = getattr(node, field, None)
+        if value.__class__ == str:
+            return '{} {}'.format(node.__class__.__name__, value)
+    return node.__class__.__name__
+
+
+def _describe_rule(rule):
+    nonterminal, parameters = rule
+    descriptions = []
+    for parameter in parameters:
+        if parameter.__class__ == _ast.MacroParameterTerminal:
+            descriptions.append(repr(''.join(parameter.symbols)))
+        elif parameter.name is None:
+            descriptions.append(parameter.symbol)
+        else:
+            descriptions.append('{}/{}'.format(parameter.symbol, parameter.name))
+    return '{} -> {}'.format(nonterminal, ', '.join(descriptions))
@@ -1,44 +1,396 @@
+from collections import namedtuple as _namedtuple
+from concurrent import futures as _futures
+import os as _os
 import os.path as _os_path
 from functools import lru_cache as _lru_cache
-from hashlib import sha512 as _sha512
+from hashlib import blake2b as _blake2b
 import pickle as _pickle
+import re as _re
+import time as _time
+import weakref as _weakref
 
 import pearl as _pearl
-from ._core_grammar import core_grammar as _core_grammar
+from ._core_grammar import core_grammar as _core_grammar, _get_grammar_patch
+from ._files import get_cache_path as _get_cache_path, replace_file as _replace_file
 from . import ast as _ast
 
 
+_parse_stats = None
+
+
+def collect_parse_stats(stats):
+    """Count the work of parsing modules from now on into stats, a pearl.ParseStats, or stop counting if it is None."""
+    global _parse_stats
+    _parse_stats = stats
+
+
 def read(module_path):
-    ast, _ = _read(module_path)
-    return ast
+    load_ast, _ = _read(module_path)
+    return load_ast()
 
 
 @_lru_cache(maxsize=256)
 def _read(module_path):
+    """Function returning the AST of the module, and the fingerprint of the grammar patch it exports.
+
+    The .langc file is up to date if the source is unchanged and the modules it imports still export the grammar
+    patches it was parsed with, which the manifest tells without reading the .langc file. Changes to modules that don't
+    alter the macros they export don't invalidate the modules importing them.
+    """
+    file_path = _get_file_path(module_path)
+    _note_read_source(module_path, file_path)
+
+    entry = _get_manifest().get(module_path)
+    if entry is not None and _is_manifest_entry_up_to_date(file_path, entry):
+        return _CachedAst(file_path), entry.fingerprint
+
+    header = _read_cache_header(file_path)
+    if header is None or not _is_source_unchanged(file_path, header) or not _are_imports_unchanged(header.imports):
+        ast, header = _parse(file_path, *_read_source(file_path))
+        load_ast = lambda: ast
+    else:
+        load_ast = _CachedAst(file_path)
+
+    _update_manifest(module_path, file_path, header)
+    return load_ast, header.fingerprint
+
+
+def _are_imports_unchanged(imports):
+    """Whether the modules in imports, a mapping from module paths to fingerprints, still export the same grammar
+    patches."""
+    return all(_read(m)[1] == fingerprint for m, fingerprint in imports.items())
+
+
+def _get_file_path(module_path):
+    """Path of the module without extension, with absolute module paths resolved to the libraries."""
     if _os_path.isabs(module_path):
-        module_path = _os_path.join(_os_path.dirname(_os_path.realpath(__file__)), 'libraries', _os_path.relpath(module_path, '/'))
+        return _os_path.join(_os_path.dirname(_os_path.realpath(__file__)), 'libraries', _os_path.relpath(module_path, '/'))
+    return module_path
+
+
+# .langc files hold two pickles: a _CacheHeader, enough to tell whether the file is up to date, and the AST, which is
+# only loaded when needed.
+_CACHE_VERSION = 4
 
-    with open(module_path + '.lang', 'rb') as file:
+# Sources modified this recently may still change within the resolution of their modification time, so their
+# headers don't record it and they are checked by digest until they are older.
+_MTIME_RESOLUTION_NS = 2 * 10 ** 9
+
+
+class _CacheHeader(_namedtuple('_CacheHeader', ['version', 'size', 'mtime_ns', 'digest', 'fingerprint', 'imports'])):
+    pass
+
+
+def _read_source(file_path):
+    """Content, digest and stat result of the source, the latter taken before reading it."""
+    stat = _os.stat(file_path + '.lang')
+    with open(file_path + '.lang', 'rb') as file:
         content = file.read()
-    digest = _sha512(content).digest()
+    return content, _blake2b(content, digest_size=32).digest(), stat
 
+
+def _read_cache_header(file_path):
     try:
-        with open(module_path + '.langc', 'rb') as cache_file:
-            cache_ast, cache_digest = _pickle.load(cache_file)
-        if cache_digest == digest and not any(changed for _, changed in map(_read, _get_imports(cache_ast))):
-            return cache_ast, False
+        with open(file_path + '.langc', 'rb') as cache_file:
+            header = _pickle.load(cache_file)
+    except (IOError, EOFError, _pickle.UnpicklingError):
+        return None
+    if header.__class__ != _CacheHeader or header.version != _CACHE_VERSION:
+        return None
+    return header
+
+
+def _is_source_unchanged(file_path, header):
+    """Whether the source is the one the header was written for: the same size and modification time, or else the same
+    digest, in which case the header is updated with the new modification time if it can be relied on."""
+    stat = _os.stat(file_path + '.lang')
+    if stat.st_size == header.size and stat.st_mtime_ns == header.mtime_ns:
+        return True
+    _, digest, stat = _read_source(file_path)
+    if digest != header.digest:
+        return False
+    mtime_ns = _get_cached_mtime_ns(stat)
+    if mtime_ns is not None:
+        with open(file_path + '.langc', 'rb') as cache_file:
+            _pickle.load(cache_file)
+            pickled_ast = cache_file.read()
+        _write_cache(file_path, header._replace(size=stat.st_size, mtime_ns=mtime_ns), pickled_ast)
+    return True
+
+
+def _get_cached_mtime_ns(stat):
+    if _time.time_ns() - stat.st_mtime_ns < _MTIME_RESOLUTION_NS:
+        return None
+    return stat.st_mtime_ns
+
+
+def _write_cache(file_path, header, pickled_ast):
+    def write(cache_file):
+        _pickle.dump(header, cache_file)
+        cache_file.write(pickled_ast)
+
+    _replace_file(file_path + '.langc', write)
+
+
+# The manifest holds a _ManifestEntry for every module read from the current directory, so that telling whether their
+# .langc files are up to date takes a stat of the source and of the .langc file each, rather than reading the latter.
+# Entries are checked against both, so a manifest that lost updates to concurrent writers is merely slower.
+_manifest = None
+
+
+class _ManifestEntry(_namedtuple('_ManifestEntry', ['size', 'mtime_ns', 'cache_mtime_ns', 'fingerprint', 'imports'])):
+    pass
+
+
+def _get_manifest():
+    global _manifest
+    if _manifest is None:
+        _manifest = _load_manifest()
+    return _manifest
+
+
+def _get_directory_cache_path(extension):
+    """Path of the cache file with extension for the current directory, which module paths are relative to."""
+    return _get_cache_path(_blake2b(_os.fsencode(_os.getcwd()), digest_size=16).hexdigest() + extension)
+
+
+def _load_manifest():
+    try:
+        with open(_get_directory_cache_path('.manifest'), 'rb') as manifest_file:
+            version, manifest = _pickle.load(manifest_file)
+    except (IOError, EOFError, ValueError, _pickle.UnpicklingError):
+        return {}
+    if version != _CACHE_VERSION:
+        return {}
+    return manifest
+
+
+def _is_manifest_entry_up_to_date(file_path, entry):
+    return _is_manifest_entry_source_unchanged(file_path, entry) and _are_imports_unchanged(entry.imports)
+
+
+def _is_manifest_entry_source_unchanged(file_path, entry):
+    """Whether the source and the .langc file are the ones the entry was written for, judging by their stats alone."""
+    try:
+        stat = _os.stat(file_path + '.lang')
+        cache_stat = _os.stat(file_path + '.langc')
+    except IOError:
+        return False
+    return entry.mtime_ns is not None and stat.st_size == entry.size and stat.st_mtime_ns == entry.mtime_ns and \
+        cache_stat.st_mtime_ns == entry.cache_mtime_ns
+
+
+def _update_manifest(module_path, file_path, header):
+    entry = _ManifestEntry(header.size, header.mtime_ns, _os.stat(file_path + '.langc').st_mtime_ns,
+                           header.fingerprint, header.imports)
+    manifest = _get_manifest()
+    if manifest.get(module_path) == entry:
+        return
+    manifest[module_path] = entry
+
+    # Written over what is on disk now, keeping the entries other processes wrote since it was loaded.
+    on_disk = _load_manifest()
+    on_disk[module_path] = entry
+    path = _get_directory_cache_path('.manifest')
+    try:
+        _os.makedirs(_os.path.dirname(path), exist_ok=True)
+        _write_pickle(path, (_CACHE_VERSION, on_disk))
     except IOError:
+        # Such as where there is no writable home directory; the headers of the .langc files are then read instead.
+        pass
+
+
+def _write_pickle(path, obj):
+    _replace_file(path, lambda file: _pickle.dump(obj, file))
+
+
+def get_module_graph(module_path):
+    """Mapping from module_path and the modules it imports, directly or not, to the source files they were last read
+    from, as far as the manifest knows them."""
+    manifest = _get_manifest()
+    graph = {}
+    unvisited = [module_path]
+    while unvisited:
+        module_path = unvisited.pop()
+        if module_path in graph:
+            continue
+        graph[module_path] = _get_file_path(module_path) + '.lang'
+        entry = manifest.get(module_path)
+        if entry is not None:
+            unvisited.extend(entry.imports)
+    return graph
+
+
+def forget():
+    """Drop the modules and grammars read so far, so that reading them again picks up changes to their sources."""
+    global _manifest, _read_directory, _analysis_states
+    from ._Module import Module
+    Module.cache_clear()
+    _read.cache_clear()
+    _get_grammar_patch.cache_clear()
+    _pearl.clear_transform_cache()
+    _manifest = None
+    _analysis_states = None
+    _read_sources.clear()
+    _read_directory = None
+
+
+def forget_changed():
+    """Forget, if the working directory or the source of a module read so far changed since it was read, returning
+    whether either did."""
+    if _read_directory is None:
+        return False
+    changed = _read_directory != _os.getcwd() or \
+        any(_get_source_signature(_get_file_path(m)) != s for m, s in _read_sources.items())
+    if changed:
+        forget()
+    return changed
+
+
+# Sizes and modification times of the sources of the modules read so far, and the working directory they were read in,
+# which the paths of modules other than libraries are relative to and the manifest is kept for.
+_read_sources = {}
+_read_directory = None
+
+
+def _note_read_source(module_path, file_path):
+    global _read_directory
+    if _read_directory is None:
+        _read_directory = _os.getcwd()
+    _read_sources[module_path] = _get_source_signature(file_path)
+
+
+def _get_source_signature(file_path):
+    try:
+        stat = _os.stat(file_path + '.lang')
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+class _CachedAst:
+    """Loads the AST of a .langc file on first call."""
+
+    def __init__(self, file_path):
+        self.__file_path = file_path
+        self.__ast = None
+
+    def __call__(self):
+        if self.__ast is None:
+            with open(self.__file_path + '.langc', 'rb') as cache_file:
+                _pickle.load(cache_file)
+                self.__ast = _pickle.load(cache_file)
+        return self.__ast
+
+
+# Keys of grammars that are the same in every process: the fingerprint of the grammar before any imports, followed by
+# the module paths and fingerprints of the imports since. The analyses of the grammars are saved under these keys to the
+# grammar cache, so that the parsers of other processes don't make them again.
+_stable_grammar_keys = _weakref.WeakKeyDictionary()
+
+# Analysis change counts of the grammars when their analyses were last saved. Restoring analyses doesn't count as a
+# change, so grammars missing here haven't any to save until it is nonzero.
+_saved_analysis_change_counts = _weakref.WeakKeyDictionary()
+
+_analysis_states = None
+
+
+def _get_imported_grammar(g, module_path):
+    """g patched by an import of module_path."""
+    _, fingerprint = _read(module_path)
+    return _patch_grammar(g, module_path, fingerprint)
+
+
+# Unlike the memo of Grammar.transform, this outlives clear_transform_cache, since the fingerprint of the grammar patch
+# of the module changes whenever the patch would.
+@_lru_cache(maxsize=256)
+def _patch_grammar(g, module_path, fingerprint):
+    imported_grammar = _get_grammar_patch(module_path)(g)
+    # Patches can give back a grammar that is known already, by adding nothing for example, which keeps its key.
+    _stable_grammar_keys.setdefault(imported_grammar, _get_stable_grammar_key(g) + ((module_path, fingerprint),))
+    _restore_analysis(imported_grammar)
+    return imported_grammar
+
+
+def _get_stable_grammar_key(g):
+    key = _stable_grammar_keys.get(g)
+    if key is None:
+        key = _stable_grammar_keys[g] = (g.fingerprint,)
+    return key
+
+
+def _get_analysis_states():
+    global _analysis_states
+    if _analysis_states is None:
+        _analysis_states = _load_analysis_states()
+    return _analysis_states
+
+
+def _load_analysis_states():
+    try:
+        with open(_get_directory_cache_path('.grammars'), 'rb') as grammar_cache_file:
+            return _pickle.load(grammar_cache_file)
+    except (IOError, EOFError, ValueError, AttributeError, _pickle.UnpicklingError):
+        return {}
+
+
+def _restore_analysis(g):
+    state = _get_analysis_states().get(_get_stable_grammar_key(g))
+    if state is not None:
+        g.restore_analysis(state)
+
+
+def _save_analyses():
+    """Save the analyses that were made or gained predictions since they were last saved to the grammar cache."""
+    changed_states = {}
+    for g, key in list(_stable_grammar_keys.items()):
+        change_count = g.analysis_change_count
+        if change_count != _saved_analysis_change_counts.get(g, 0):
+            _saved_analysis_change_counts[g] = change_count
+            changed_states[key] = g.get_analysis_state()
+    if not changed_states:
+        return
+    _get_analysis_states().update(changed_states)
+
+    on_disk = _load_analysis_states()
+    on_disk.update(changed_states)
+    path = _get_directory_cache_path('.grammars')
+    try:
+        _os.makedirs(_os.path.dirname(path), exist_ok=True)
+        _write_pickle(path, on_disk)
+    except (IOError, _pickle.PicklingError, AttributeError, TypeError):
+        # Such as where there is no writable home directory. Grammars with terminals that can't be pickled, such as
+        # character classes with predicates, can't be cached either.
         pass
 
+
+def _parse(file_path, content, digest, stat):
+    _restore_analysis(_core_grammar)
     try:
-        ast = _pearl.parse(_core_grammar, str(content, 'UTF-8'), allow_ambiguous=False)
+        ast = _pearl.parse(_core_grammar, str(content, 'UTF-8'), allow_ambiguous=False, deferred=True,
+                           stats=_parse_stats)
     except _pearl.AmbiguousParse as e:
-        raise Exception('In file {}.lang'.format(module_path)) from e
+        raise Exception('In file {}.lang'.format(file_path)) from e
+    _save_analyses()
+
+    imports = {m: _read(m)[1] for m in _get_imports(ast)}
+    header = _CacheHeader(_CACHE_VERSION, stat.st_size, _get_cached_mtime_ns(stat), digest,
+                          _get_grammar_patch_fingerprint(ast), imports)
+    _write_cache(file_path, header, _pickle.dumps(ast))
+
+    return ast, header
+
 
-    with open(module_path + '.langc', 'wb') as cache_file:
-        _pickle.dump((ast, digest), cache_file)
+def _get_grammar_patch_fingerprint(ast):
+    """Digest of what the module contributes to the grammar of the modules importing it: its exported macro definitions
+    and undefinitions, without their bodies."""
+    patch = []
 
-    return ast, True
+    for s in ast.statements:
+        if s.__class__ in (_ast.MacroDefinition, _ast.MacroUndefinition) and s.exported:
+            patch.append((s.__class__.__name__, s.nonterminal, s.parameters))
+
+    return _blake2b(repr(patch).encode('UTF-8'), digest_size=16).digest()
 
 
 def _get_imports(ast):
@@ -49,3 +401,73 @@ def _get_imports(ast):
             imports.add(s.module_path)
 
     return imports
+
+
+_import_pattern = _re.compile(rb'\bimport\s*\'([^\'\\]*)\'')
+_comment_pattern = _re.compile(rb'#[^\n]*')
+
+
+def preload(module_path, *, jobs=None):
+    """Parse the modules that module_path imports, directly or not, and the module itself wherever their .langc files
+    are out of date, up to jobs of them at once in separate processes, each after the modules it imports.
+
+    The imports of a module without an up to date .langc file are found by scanning its text for import statements, so
+    they may be wrong; read parses whatever is still out of date afterwards, and reports any errors. It also parses the
+    modules whose sources are unchanged but whose imports now export different grammar patches, which can only be told
+    once those are parsed.
+    """
+    imports = {}
+    out_of_date = set()
+    unvisited = [module_path]
+    while unvisited:
+        module_path = unvisited.pop()
+        if module_path in imports:
+            continue
+        file_path = _get_file_path(module_path)
+        try:
+            cached_imports = _get_cached_imports(module_path, file_path)
+            if cached_imports is not None:
+                imports[module_path] = set(cached_imports)
+            else:
+                content, _, _ = _read_source(file_path)
+                imports[module_path] = {str(m, 'UTF-8') for m in _import_pattern.findall(_comment_pattern.sub(b'', content))}
+                out_of_date.add(module_path)
+        except IOError:
+            imports[module_path] = set()
+            continue
+        unvisited.extend(imports[module_path])
+
+    if len(out_of_date) < 2:
+        return
+
+    waiting = {m: imports[m] & out_of_date for m in out_of_date}
+    with _futures.ProcessPoolExecutor(jobs) as executor:
+        running = {}
+        while True:
+            for module_path in [m for m, m_imports in waiting.items() if not m_imports]:
+                del waiting[module_path]
+                running[executor.submit(_parse_module, module_path)] = module_path
+            if not running:
+                break
+            done, _ = _futures.wait(running, return_when=_futures.FIRST_COMPLETED)
+            for future in done:
+                module_path = running.pop(future)
+                if future.exception() is None:
+                    for module_imports in waiting.values():
+                        module_imports.discard(module_path)
+
+
+def _get_cached_imports(module_path, file_path):
+    """Imports of the module as of its .langc file, or None if its source changed since."""
+    entry = _get_manifest().get(module_path)
+    if entry is not None and _is_manifest_entry_source_unchanged(file_path, entry):
+        return entry.imports
+    header = _read_cache_header(file_path)
+    if header is not None and _is_source_unchanged(file_path, header):
+        return header.imports
+    return None
+
+
+def _parse_module(module_path):
+    file_path = _get_file_path(module_path)
+    _parse(file_path, *_read_source(file_path))
@@ -3,8 +3,34 @@ from collections import namedtuple as _namedtuple
 
 class StatementSequence(_namedtuple('Nothing', ['statements'])):
     def execute(self, context):
+        _complete(self._execute(context))
+
+    def _execute(self, context):
         for statement in self.statements:
-            statement.execute(context)
+            if statement.__class__ in _completing_classes:
+                completion = statement._execute(context)
+                if completion is not None:
+                    return completion
+            else:
+                statement.execute(context)
+
+    def compile(self, scope=None):
+        return _compile_completing(self._compile(scope))
+
+    def _compile(self, scope=None):
+        statements = tuple((s._compile(scope), True) if s.__class__ in _completing_classes else (s.compile(scope), False)
+                           for s in self.statements)
+
+        def run(context):
+            for statement, completing in statements:
+                if completing:
+                    completion = statement(context)
+                    if completion is not None:
+                        return completion
+                else:
+                    statement(context)
+
+        return run
 
 
 class Import(_namedtuple('UnusedExpression', ['exported', 'module_path'])):
@@ -20,11 +46,40 @@ class Import(_namedtuple('UnusedExpression', ['exported', 'module_path'])):
         for rule, definition in module.exported_macro_definitions.items():
             context.define_macro(rule, definition)
 
+    def compile(self, scope=None):
+        from ._Module import Module
+
+        module_path = self.module_path
+
+        def run(context):
+            module = Module(module_path, compiled=True)
+
+            for name, value in module.exported_variables.items():
+                context.declare_variable(name)
+                context.assign_variable(name, value)
+
+            for rule, definition in module.exported_macro_definitions.items():
+                context.define_macro(rule, definition)
+
+        return run
+
 
 class VariableDeclaration(_namedtuple('VariableDeclaration', ['exported', 'name'])):
     def execute(self, context):
         context.declare_variable(self.name)
 
+    def compile(self, scope=None):
+        name = self.name
+        depth, index = _resolve(scope, name)
+        if depth != 0 or index is None:
+            return lambda context: context.declare_variable(name)
+
+        def run(context):
+            if context.slots[index] is _UNDECLARED:
+                context.slots[index] = Context.UNASSIGNED_VARIABLE
+
+        return run
+
 
 class MacroParameterTerminal(_namedtuple('MacroParameterTerminal', ['symbols'])):
     pass
@@ -32,46 +87,180 @@ class MacroParameterTerminal(_namedtuple('MacroParameterTerminal', ['symbols']))
 class MacroParameterNonterminal(_namedtuple('MacroParameterNonterminal', ['symbol', 'name'])):
     pass
 
-class MacroDefinition(_namedtuple('MacroDefinition', ['exported', 'nonterminal', 'parameters', 'definition'])):
+class MacroDefinition(_namedtuple('MacroDefinition', ['exported', 'nonterminal', 'parameters', 'definition', 'expansion'],
+                                  defaults=(False,))):
     def execute(self, context):
         definition = self.definition.execute(context)
+        definition.expansion = self.expansion
         context.define_macro((self.nonterminal, self.parameters), definition)
 
+    def compile(self, scope=None):
+        rule = self.nonterminal, self.parameters
+        definition = self.definition.compile(scope)
+        expansion = self.expansion
+
+        def run(context):
+            value = definition(context)
+            value.expansion = expansion
+            context.define_macro(rule, value)
+
+        return run
+
 
 class MacroUse(_namedtuple('MacroUse', ['nonterminal', 'parameters', 'nodes'])):
     def execute(self, context):
         definition = context.get_macro_definition((self.nonterminal, self.parameters))
+        if definition.expansion:
+            return _expand(self, definition).execute(context)
         return definition(context, *self.nodes)
 
+    def _execute(self, context):
+        definition = context.get_macro_definition((self.nonterminal, self.parameters))
+        if definition.expansion:
+            return _execute_statement(_expand(self, definition), context)
+        definition(context, *self.nodes)
+
+    def compile(self, scope=None):
+        nodes = self.nodes
+
+        def compile_definition(definition):
+            return lambda context: definition(context, *nodes)
+
+        return self.__compile(lambda expansion: expansion.compile(scope), compile_definition)
+
+    def _compile(self, scope=None):
+        nodes = self.nodes
+
+        def compile_definition(definition):
+            def run(context):
+                definition(context, *nodes)
+
+            return run
+
+        return self.__compile(lambda expansion: _compile_statement(expansion, scope), compile_definition)
+
+    def __compile(self, compile_expansion, compile_definition):
+        rule = self.nonterminal, self.parameters
+        # The definition last used here and how to run the use with it: the expansion stays compiled for as long as
+        # the definition the use resolves to stays the same.
+        used_definition = None
+        run_use = None
+
+        def run(context):
+            nonlocal used_definition, run_use
+            definition = context.get_macro_definition(rule)
+            if definition is not used_definition:
+                if definition.expansion:
+                    run_use = compile_expansion(_expand(self, definition))
+                else:
+                    run_use = compile_definition(definition)
+                used_definition = definition
+            return run_use(context)
+
+        return run
+
 
 class MacroUndefinition(_namedtuple('MacroUndefinition', ['exported', 'nonterminal', 'parameters'])):
     def execute(self, context):
         pass
 
+    def compile(self, scope=None):
+        return lambda context: None
+
 
 class Block(_namedtuple('Block', ['body'])):
     def execute(self, context):
+        _complete(self._execute(context))
+
+    def _execute(self, context):
         local_context = Context(context)
-        self.body.execute(local_context)
+        return self.body._execute(local_context)
+
+    def compile(self, scope=None):
+        return _compile_completing(self._compile(scope))
+
+    def _compile(self, scope=None):
+        slot_names = _get_slot_names(self.body)
+        body = self.body._compile(_Scope(scope, slot_names))
+        if slot_names is None:
+            return lambda context: body(Context(context))
+        return lambda context: body(Context(context, slot_names))
 
 
 class If(_namedtuple('IfElse', ['condition', 'true_clause', 'false_clause'])):
     def execute(self, context):
+        _complete(self._execute(context))
+
+    def _execute(self, context):
         if self.condition.execute(context):
-            self.true_clause.execute(context)
+            clause = self.true_clause
         else:
-            self.false_clause.execute(context)
+            clause = self.false_clause
+        if clause.__class__ in _completing_classes:
+            return clause._execute(context)
+        clause.execute(context)
+
+    def compile(self, scope=None):
+        return _compile_completing(self._compile(scope))
+
+    def _compile(self, scope=None):
+        condition = self.condition.compile(scope)
+        true_clause = _compile_statement(self.true_clause, scope)
+        false_clause = _compile_statement(self.false_clause, scope)
+
+        def run(context):
+            if condition(context):
+                return true_clause(context)
+            else:
+                return false_clause(context)
+
+        return run
 
 
 class Forever(_namedtuple('Forever', ['body'])):
     def execute(self, context):
+        _complete(self._execute(context))
+
+    def _execute(self, context):
+        body = self.body
+        completing = body.__class__ in _completing_classes
         while True:
+            # Macros running the body themselves raise the completions they don't handle.
             try:
-                self.body.execute(context)
+                if completing:
+                    completion = body._execute(context)
+                else:
+                    body.execute(context)
+                    completion = None
             except Continue.Exception:
                 continue
             except Break.Exception:
                 break
+            if completion is Break.Exception:
+                break
+            if completion is not None and completion is not Continue.Exception:
+                return completion
+
+    def compile(self, scope=None):
+        return _compile_completing(self._compile(scope))
+
+    def _compile(self, scope=None):
+        body = _compile_statement(self.body, scope)
+
+        def run(context):
+            while True:
+                try:
+                    completion = body(context)
+                except Continue.Exception:
+                    continue
+                except Break.Exception:
+                    break
+                if completion is Break.Exception:
+                    break
+                if completion is not None and completion is not Continue.Exception:
+                    return completion
+
+        return run
 
 
 class Continue(_namedtuple('Continue', [])):
@@ -81,6 +270,15 @@ class Continue(_namedtuple('Continue', [])):
     def execute(self, context):
         raise Continue.Exception()
 
+    def _execute(self, context):
+        return Continue.Exception
+
+    def compile(self, scope=None):
+        return self.execute
+
+    def _compile(self, scope=None):
+        return self._execute
+
 
 class Break(_namedtuple('Break', [])):
     class Exception(Exception):
@@ -89,6 +287,15 @@ class Break(_namedtuple('Break', [])):
     def execute(self, context):
         raise Break.Exception()
 
+    def _execute(self, context):
+        return Break.Exception
+
+    def compile(self, scope=None):
+        return self.execute
+
+    def _compile(self, scope=None):
+        return self._execute
+
 
 class Return(_namedtuple('Return', ['value'])):
     class Exception(Exception):
@@ -100,8 +307,18 @@ class Return(_namedtuple('Return', ['value'])):
             return self.__value
 
     def execute(self, context):
+        raise self._execute(context)
+
+    def _execute(self, context):
         value = self.value.execute(context)
-        raise Return.Exception(value)
+        return Return.Exception(value)
+
+    def compile(self, scope=None):
+        return _compile_completing(self._compile(scope))
+
+    def _compile(self, scope=None):
+        value = self.value.compile(scope)
+        return lambda context: Return.Exception(value(context))
 
 
 class VariableAssignment(_namedtuple('VariableAssignment', ['name', 'value'])):
@@ -109,6 +326,32 @@ class VariableAssignment(_namedtuple('VariableAssignment', ['name', 'value'])):
         value = self.value.execute(context)
         context.assign_variable(self.name, value)
 
+    def compile(self, scope=None):
+        name = self.name
+        value = self.value.compile(scope)
+        depth, index = _resolve(scope, name)
+
+        if index is None:
+            return lambda context: context.assign_variable(name, value(context))
+
+        if depth == 0:
+            def run(context):
+                v = value(context)
+                if context.slots[index] is _UNDECLARED:
+                    context.assign_variable(name, v)
+                else:
+                    context.slots[index] = v
+        else:
+            def run(context):
+                v = value(context)
+                target = _get_ancestor(context, depth)
+                if target is None or target.slots[index] is _UNDECLARED:
+                    context.assign_variable(name, v)
+                else:
+                    target.slots[index] = v
+
+        return run
+
 
 class AttributeAssignment(_namedtuple('AttributeAssignment', ['object', 'attribute_name', 'value'])):
     def execute(self, context):
@@ -116,12 +359,59 @@ class AttributeAssignment(_namedtuple('AttributeAssignment', ['object', 'attribu
         object = self.object.execute(context)
         setattr(object, self.attribute_name, value)
 
+    def compile(self, scope=None):
+        object = self.object.compile(scope)
+        attribute_name = self.attribute_name
+        value = self.value.compile(scope)
+
+        def run(context):
+            v = value(context)
+            setattr(object(context), attribute_name, v)
+
+        return run
+
 
 class VariableAccess(_namedtuple('VariableAccess', ['name'])):
     def execute(self, context):
         value = context.access_variable(self.name)
         return value
 
+    def compile(self, scope=None):
+        name = self.name
+        if name == '__context__':
+            return lambda context: context
+        depth, index = _resolve(scope, name)
+
+        if index is None:
+            if depth == 0:
+                return lambda context: context.access_variable(name)
+
+            def run(context):
+                source = _get_ancestor(context, depth)
+                if source is None:
+                    return context.access_variable(name)
+                return source.access_variable(name)
+
+            return run
+
+        if depth == 0:
+            def run(context):
+                value = context.slots[index]
+                if value is _UNDECLARED or value is Context.UNASSIGNED_VARIABLE:
+                    return context.access_variable(name)
+                return value
+        else:
+            def run(context):
+                source = _get_ancestor(context, depth)
+                if source is None:
+                    return context.access_variable(name)
+                value = source.slots[index]
+                if value is _UNDECLARED or value is Context.UNASSIGNED_VARIABLE:
+                    return context.access_variable(name)
+                return value
+
+        return run
+
 
 class AttributeAccess(_namedtuple('AttributeAccess', ['object', 'attribute_name'])):
     def execute(self, context):
@@ -129,16 +419,29 @@ class AttributeAccess(_namedtuple('AttributeAccess', ['object', 'attribute_name'
         value = getattr(object, self.attribute_name)
         return value
 
+    def compile(self, scope=None):
+        object = self.object.compile(scope)
+        attribute_name = self.attribute_name
+        return lambda context: getattr(object(context), attribute_name)
+
 
 class NumberLiteral(_namedtuple('NumberLiteral', ['value'])):
     def execute(self, context):
         return self.value
 
+    def compile(self, scope=None):
+        value = self.value
+        return lambda context: value
+
 
 class StringLiteral(_namedtuple('StringLiteral', ['value'])):
     def execute(self, context):
         return self.value
 
+    def compile(self, scope=None):
+        value = self.value
+        return lambda context: value
+
 
 class FunctionLiteral(_namedtuple('FunctionLiteral', ['parameters', 'body'])):
     def execute(self, context):
@@ -150,15 +453,80 @@ class FunctionLiteral(_namedtuple('FunctionLiteral', ['parameters', 'body'])):
                 local_context.declare_variable(name)
                 local_context.assign_variable(name, value)
             try:
-                self.body.execute(local_context)
+                completion = _execute_statement(self.body, local_context)
             except Return.Exception as j:
                 return j.value
+            if completion is not None:
+                return _get_returned_value(completion)
 
         value.body = self.body
         value.context = context
 
         return value
 
+    def compile(self, scope=None):
+        assert '__context__' not in self.parameters
+
+        parameters = self.parameters
+        slot_names = _get_slot_names(self.body, parameters)
+        local_scope = _Scope(scope, slot_names)
+        # Functions built by macros may have a single statement for a body.
+        statements = self.body.statements if self.body.__class__ == StatementSequence else (self.body,)
+        # A return ending the body returns directly, rather than through a completion.
+        if statements and statements[-1].__class__ == Return:
+            body = StatementSequence(statements[:-1])._compile(local_scope)
+            result = statements[-1].value.compile(local_scope)
+        else:
+            body = StatementSequence(statements)._compile(local_scope)
+            result = lambda context: None
+        body_node = self.body
+        if slot_names is not None:
+            undeclared_slots = [_UNDECLARED] * (len(slot_names) - len(parameters))
+
+        def run(context):
+            def value(*arguments):
+                if len(parameters) != len(arguments):
+                    raise TypeError('Expected {} arguments, got {}'.format(len(parameters), len(arguments)))
+                if slot_names is None:
+                    local_context = Context(context)
+                    local_context.variables.update(zip(parameters, arguments))
+                else:
+                    local_context = Context(context, slot_names, list(arguments) + undeclared_slots)
+                try:
+                    completion = body(local_context)
+                    if completion is None:
+                        return result(local_context)
+                except Return.Exception as j:
+                    return j.value
+                return _get_returned_value(completion)
+
+            value.body = body_node
+            value.context = context
+
+            return value
+
+        return run
+
+
+class MethodCall(_namedtuple('MethodCall', ['object', 'method_name', 'arguments'])):
+    def execute(self, context):
+        object = self.object.execute(context)
+        arguments = [a.execute(context) for a in self.arguments]
+        value = getattr(object, self.method_name)(*arguments)
+        return value
+
+    def compile(self, scope=None):
+        object = self.object.compile(scope)
+        method_name = self.method_name
+        arguments = tuple(a.compile(scope) for a in self.arguments)
+
+        def run(context):
+            o = object(context)
+            values = [a(context) for a in arguments]
+            return getattr(o, method_name)(*values)
+
+        return run
+
 
 class Call(_namedtuple('Call', ['callable', 'arguments'])):
     def execute(self, context):
@@ -167,50 +535,268 @@ class Call(_namedtuple('Call', ['callable', 'arguments'])):
         value = invocable(*arguments)
         return value
 
+    def compile(self, scope=None):
+        arguments = tuple(a.compile(scope) for a in self.arguments)
+
+        if self.callable.__class__ == AttributeAccess and self.callable.attribute_name == 'execute' and len(arguments) == 1:
+            # Macros execute the nodes they are given, which then run compiled too.
+            object = self.callable.object.compile(scope)
+            argument, = arguments
+
+            def run(context):
+                a = argument(context)
+                o = object(context)
+                if o.__class__ in _node_classes:
+                    return _compile_node(o)(a)
+                return o.execute(a)
+
+            return run
+
+        invocable = self.callable.compile(scope)
+
+        def run(context):
+            values = [a(context) for a in arguments]
+            return invocable(context)(*values)
+
+        return run
+
+
+_node_classes = frozenset({StatementSequence, Import, VariableDeclaration, MacroDefinition, MacroUse, MacroUndefinition,
+                           Block, If, Forever, Continue, Break, Return, VariableAssignment, AttributeAssignment,
+                           VariableAccess, AttributeAccess, NumberLiteral, StringLiteral, FunctionLiteral, MethodCall, Call})
+
+# Compiled forms of the nodes executed by compiled code are kept on the nodes, as _compiled, along with the generation
+# they were compiled in. Forgetting them all, as when the node classes are instrumented, starts a new generation.
+_compilation_generation = 0
+
+
+def _forget_compiled_nodes():
+    global _compilation_generation
+    _compilation_generation += 1
+
+
+# Attributes that nodes cache things in as they run, which aren't pickled.
+_CACHE_ATTRIBUTES = frozenset({'_compiled', '_expansion'})
+
+
+def _get_node_state(node):
+    state = {name: value for name, value in node.__dict__.items() if name not in _CACHE_ATTRIBUTES}
+    return state or None
+
+
+for _node_class in _node_classes:
+    _node_class.__getstate__ = _get_node_state
+
+
+class _Scope:
+    """What compiled code knows of the context it runs in: slot_names maps the variables declared directly in it to
+    their slots, or is None if that can't be known, as where modules are imported. The parent is the scope of the
+    parent context."""
+
+    def __init__(self, parent, slot_names):
+        self.parent = parent
+        self.slot_names = slot_names
+
+
+def _resolve(scope, name):
+    """Depth of the context the variable is declared in and its slot there, or the depth of the first context without
+    slots and None, where the variable is to be looked up by name."""
+    depth = 0
+    while scope is not None and scope.slot_names is not None:
+        index = scope.slot_names.get(name)
+        if index is not None:
+            return depth, index
+        scope = scope.parent
+        depth += 1
+    return depth, None
+
+
+def _get_ancestor(context, depth):
+    """The context depth levels up, or None if variables beyond the slots were declared in one on the way, which the
+    resolution of compiled code couldn't take into account."""
+    for _ in range(depth):
+        if context.variables:
+            return None
+        context = context.parent
+    return context
+
+
+def _get_slot_names(body, parameters=()):
+    """Slots for the parameters and the variables declared in body, or None if they can't be known."""
+    slot_names = {}
+    for name in parameters:
+        if name in slot_names:
+            return None
+        slot_names[name] = len(slot_names)
+    if not _collect_declarations(body, slot_names):
+        return None
+    return slot_names
+
+
+def _collect_declarations(node, slot_names):
+    """Give the variables node declares in the context it runs in slots, returning False if it may declare others."""
+    if node.__class__ == VariableDeclaration:
+        slot_names.setdefault(node.name, len(slot_names))
+        return True
+    if node.__class__ == Import:
+        return False
+    # Blocks and functions run in contexts of their own, and macros run the nodes they are given where they like;
+    # variables they declare in this context anyway end up beyond the slots.
+    if node.__class__ in (Block, FunctionLiteral, MacroUse):
+        return True
+    for field in node:
+        children = field if field.__class__ == tuple else (field,)
+        for child in children:
+            if child.__class__ in _node_classes and not _collect_declarations(child, slot_names):
+                return False
+    return True
+
+
+# Nodes that can end abruptly, by break, continue or return. Besides execute and compile, they have _execute and
+# _compile, which return how they ended, as the exception execute would raise or None, rather than raising it. Raising
+# and catching an exception is left to where the ending crosses a macro running the node itself.
+_completing_classes = frozenset({StatementSequence, MacroUse, Block, If, Forever, Continue, Break, Return})
+
+
+def _complete(completion):
+    if completion is not None:
+        raise completion
+
+
+def _compile_completing(run):
+    """Compiled form raising the completion the compiled form run returns."""
+    def run_completing(context):
+        completion = run(context)
+        if completion is not None:
+            raise completion
+
+    return run_completing
+
+
+def _execute_statement(node, context):
+    if node.__class__ in _completing_classes:
+        return node._execute(context)
+    node.execute(context)
+
+
+def _compile_statement(node, scope):
+    if node.__class__ in _completing_classes:
+        return node._compile(scope)
+    run = node.compile(scope)
+
+    def run_statement(context):
+        run(context)
+
+    return run_statement
+
+
+def _get_returned_value(completion):
+    """Value returned by a function body that ended with completion, which only a return may end it with."""
+    if completion.__class__ != Return.Exception:
+        raise completion
+    return completion.value
+
+
+def _compile_node(node):
+    compiled = node.__dict__.get('_compiled')
+    if compiled is not None and compiled[0] == _compilation_generation:
+        return compiled[1]
+    run = node.compile()
+    node._compiled = _compilation_generation, run
+    return run
+
+
+def _expand(use, definition):
+    """The node the expansion macro definition expands use to, expanding it only once for as long as the use resolves to
+    the same definition. The expansion is kept on the use, as _expansion, along with the definition."""
+    expansion = use.__dict__.get('_expansion')
+    if expansion is not None and expansion[0] is definition:
+        return expansion[1]
+    node = definition(*use.nodes)
+    if node.__class__ not in _node_classes:
+        raise TypeError('Expansion of macro {} is {!r}, not a node'.format(use.nonterminal, node))
+    use._expansion = definition, node
+    return node
+
+
+# Value of the slots of variables that aren't declared yet.
+_UNDECLARED = object()
+
 
 class Context:
+    """Variables and macro definitions of a scope.
+
+    Contexts of compiled blocks and functions keep the variables declared in them in slots, which slot_names maps names
+    to; variables holds those declared otherwise, such as by macros.
+    """
+
     UNASSIGNED_VARIABLE = object()
 
-    def __init__(self, parent=None):
-        self.__parent = parent
+    def __init__(self, parent=None, slot_names=None, slots=None):
+        self.parent = parent
         self.variables = {}
         self.macro_definitions = {}
+        self.slot_names = slot_names
+        if slot_names is not None and slots is None:
+            slots = [_UNDECLARED] * len(slot_names)
+        self.slots = slots
 
     def declare_variable(self, name):
         assert name != '__context__'
 
+        if self.slot_names is not None:
+            index = self.slot_names.get(name)
+            if index is not None:
+                if self.slots[index] is _UNDECLARED:
+                    self.slots[index] = Context.UNASSIGNED_VARIABLE
+                return
         self.variables.setdefault(name, Context.UNASSIGNED_VARIABLE)
 
     def assign_variable(self, name, value):
         assert name != '__context__'
 
-        if name in self.variables:
-            self.variables[name] = value
-        elif self.__parent is not None:
-            self.__parent.assign_variable(name, value)
-        else:
-            raise Exception('Assignment to undeclared variable \'{}\''.format(name))
+        context = self
+        while True:
+            if name in context.variables:
+                context.variables[name] = value
+                return
+            if context.slot_names is not None:
+                index = context.slot_names.get(name)
+                if index is not None and context.slots[index] is not _UNDECLARED:
+                    context.slots[index] = value
+                    return
+            context = context.parent
+            if context is None:
+                raise Exception('Assignment to undeclared variable \'{}\''.format(name))
 
     def access_variable(self, name):
         if name == '__context__':
             return self
 
-        if name in self.variables:
-            value = self.variables[name]
-            if value is Context.UNASSIGNED_VARIABLE:
-                raise Exception('Use of unassigned variable \'{}\''.format(name))
-            return value
-        elif self.__parent is not None:
-            return self.__parent.access_variable(name)
-        else:
-            raise Exception('Use of undeclared variable \'{}\''.format(name))
+        context = self
+        while True:
+            variables = context.variables
+            if name in variables:
+                value = variables[name]
+                break
+            if context.slot_names is not None:
+                index = context.slot_names.get(name)
+                if index is not None and context.slots[index] is not _UNDECLARED:
+                    value = context.slots[index]
+                    break
+            context = context.parent
+            if context is None:
+                raise Exception('Use of undeclared variable \'{}\''.format(name))
+        if value is Context.UNASSIGNED_VARIABLE:
+            raise Exception('Use of unassigned variable \'{}\''.format(name))
+        return value
 
     def define_macro(self, rule, definition):
         self.macro_definitions[rule] = definition
 
     def get_macro_definition(self, rule):
-        try:
-            return self.macro_definitions[rule]
-        except KeyError:
-            assert self.__parent is not None
-            return self.__parent.get_macro_definition(rule)
\ No newline at end of file
+        context = self
+        while rule not in context.macro_definitions:
+            context = context.parent
+            assert context is not None
+        return context.macro_definitions[rule]
\ No newline at end of file
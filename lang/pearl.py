@@ -1,9 +1,394 @@
 from collections import namedtuple as _namedtuple
 from collections import defaultdict as _defaultdict
+from collections import Counter as _Counter
+from hashlib import blake2b as _blake2b
+import itertools as _itertools
+import pickle as _pickle
+import re as _re
+import time as _time
+import weakref as _weakref
+
+
+_TRIE_BITS = 5
+_TRIE_MASK = (1 << _TRIE_BITS) - 1
+_TRIE_HASH_MASK = (1 << 64) - 1
+
+
+class _TrieLeaf(_namedtuple('_TrieLeaf', ['hash', 'key', 'value'])):
+    pass
+
+
+class _TrieCollision(_namedtuple('_TrieCollision', ['hash', 'leaves'])):
+    pass
+
+
+class _TrieNode(_namedtuple('_TrieNode', ['bitmap', 'children'])):
+    def locate(self, hash, shift):
+        bit = 1 << ((hash >> shift) & _TRIE_MASK)
+        return bit, bin(self.bitmap & (bit - 1)).count('1')
+
+
+_EMPTY_TRIE_NODE = _TrieNode(0, ())
+
+
+def _trie_pair(a, b, shift):
+    a_index = (a.hash >> shift) & _TRIE_MASK
+    b_index = (b.hash >> shift) & _TRIE_MASK
+    if a_index == b_index:
+        return _TrieNode(1 << a_index, (_trie_pair(a, b, shift + _TRIE_BITS),))
+    if a_index > b_index:
+        a, b = b, a
+    return _TrieNode((1 << a_index) | (1 << b_index), (a, b))
+
+
+def _trie_set(node, leaf, shift):
+    bit, index = node.locate(leaf.hash, shift)
+    if not node.bitmap & bit:
+        return _TrieNode(node.bitmap | bit, node.children[:index] + (leaf,) + node.children[index:]), None
+    child = node.children[index]
+    replaced = None
+    if child.__class__ == _TrieNode:
+        child, replaced = _trie_set(child, leaf, shift + _TRIE_BITS)
+    elif child.hash != leaf.hash:
+        child = _trie_pair(child, leaf, shift + _TRIE_BITS)
+    elif child.__class__ == _TrieLeaf:
+        if child.key == leaf.key:
+            child, replaced = leaf, child
+        else:
+            child = _TrieCollision(leaf.hash, (child, leaf))
+    else:
+        leaves = list(child.leaves)
+        for i, l in enumerate(leaves):
+            if l.key == leaf.key:
+                leaves[i], replaced = leaf, l
+                break
+        else:
+            leaves.append(leaf)
+        child = _TrieCollision(leaf.hash, tuple(leaves))
+    return _TrieNode(node.bitmap, node.children[:index] + (child,) + node.children[index + 1:]), replaced
+
+
+def _trie_remove(node, hash, key, shift):
+    bit, index = node.locate(hash, shift)
+    if not node.bitmap & bit:
+        return node, None
+    child = node.children[index]
+    if child.__class__ == _TrieNode:
+        child, removed = _trie_remove(child, hash, key, shift + _TRIE_BITS)
+        if removed is not None and len(child.children) == 1 and child.children[0].__class__ != _TrieNode:
+            child = child.children[0]
+    elif child.hash != hash:
+        return node, None
+    elif child.__class__ == _TrieLeaf:
+        if not child.key == key:
+            return node, None
+        child, removed = None, child
+    else:
+        leaves = [l for l in child.leaves if not l.key == key]
+        if len(leaves) == len(child.leaves):
+            return node, None
+        removed = next(l for l in child.leaves if l.key == key)
+        child = leaves[0] if len(leaves) == 1 else _TrieCollision(hash, tuple(leaves))
+    if removed is None:
+        return node, None
+    if child is None or (child.__class__ == _TrieNode and not child.children):
+        return _TrieNode(node.bitmap & ~bit, node.children[:index] + node.children[index + 1:]), removed
+    return _TrieNode(node.bitmap, node.children[:index] + (child,) + node.children[index + 1:]), removed
+
+
+def _trie_leaves(node):
+    for child in node.children:
+        if child.__class__ == _TrieNode:
+            yield from _trie_leaves(child)
+        elif child.__class__ == _TrieCollision:
+            yield from child.leaves
+        else:
+            yield child
+
+
+class _HashTrie:
+    """Immutable hash array mapped trie. Updates are O(log n) and share structure with the original."""
+
+    __slots__ = ['__root', '__length']
+
+    def __init__(self, *, _root=_EMPTY_TRIE_NODE, _length=0):
+        self.__root = _root
+        self.__length = _length
+
+    def __len__(self):
+        return self.__length
+
+    def __iter__(self):
+        for leaf in _trie_leaves(self.__root):
+            yield leaf.key
+
+    def items(self):
+        for leaf in _trie_leaves(self.__root):
+            yield leaf.key, leaf.value
+
+    def values(self):
+        for leaf in _trie_leaves(self.__root):
+            yield leaf.value
+
+    def get(self, key, default=None):
+        hash_ = hash(key) & _TRIE_HASH_MASK
+        node = self.__root
+        shift = 0
+        while True:
+            bit, index = node.locate(hash_, shift)
+            if not node.bitmap & bit:
+                return default
+            node = node.children[index]
+            if node.__class__ == _TrieNode:
+                shift += _TRIE_BITS
+                continue
+            if node.hash != hash_:
+                return default
+            if node.__class__ == _TrieLeaf:
+                return node.value if node.key == key else default
+            for leaf in node.leaves:
+                if leaf.key == key:
+                    return leaf.value
+            return default
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def set(self, key, value):
+        root, replaced = _trie_set(self.__root, _TrieLeaf(hash(key) & _TRIE_HASH_MASK, key, value), 0)
+        return _HashTrie(_root=root, _length=self.__length + (replaced is None))
+
+    def remove(self, key):
+        root, removed = _trie_remove(self.__root, hash(key) & _TRIE_HASH_MASK, key, 0)
+        if removed is None:
+            return self
+        return _HashTrie(_root=root, _length=self.__length - 1)
+
+
+_MISSING = object()
+
+
+class _RuleSet:
+    """Persistent set of the rules sharing a head. Its hash is maintained incrementally."""
+
+    __slots__ = ['__rules', '__hash']
+
+    def __init__(self, *, _rules=_HashTrie(), _hash=0):
+        self.__rules = _rules
+        self.__hash = _hash
+
+    def __len__(self):
+        return len(self.__rules)
+
+    def __iter__(self):
+        return self.__rules.values()
+
+    def __contains__(self, rule):
+        return rule in self.__rules
+
+    def __hash__(self):
+        return self.__hash
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if other.__class__ != _RuleSet or self.__hash != other.__hash or len(self) != len(other):
+            return False
+        for rule in self.__rules.values():
+            other_rule = other.__rules.get(rule)
+            if other_rule is None or not rule.has_same_actions(other_rule):
+                return False
+        return True
+
+    def put(self, rule):
+        """Add rule, replacing the rule with the same head and body, if any."""
+        old_rule = self.__rules.get(rule)
+        hash_ = self.__hash ^ rule.full_hash
+        if old_rule is not None:
+            hash_ ^= old_rule.full_hash
+        return _RuleSet(_rules=self.__rules.set(rule, rule), _hash=hash_)
+
+    def drop(self, rule):
+        old_rule = self.__rules.get(rule)
+        if old_rule is None:
+            return self
+        return _RuleSet(_rules=self.__rules.remove(rule), _hash=self.__hash ^ old_rule.full_hash)
+
+
+_EMPTY_RULE_SET = _RuleSet()
+
+
+class CharacterClass:
+    """Terminal matching any single character that is one of characters, lies in one of the inclusive (low, high)
+    ranges, belongs to one of the Unicode categories (either 'Lu' or just 'L') or satisfies predicate."""
+
+    def __init__(self, characters='', *, ranges=(), categories=(), predicate=None):
+        assert all(low.__class__ == str and high.__class__ == str and len(low) == len(high) == 1 for low, high in ranges)
+        assert predicate is None or callable(predicate)
+
+        self.__characters = frozenset(characters)
+        self.__ranges = tuple(sorted(ranges))
+        self.__categories = frozenset(categories)
+        self.__predicate = predicate
+        self.__key = self.__characters, self.__ranges, self.__categories, self.__predicate
+        self.__memo = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_CharacterClass__memo']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__memo = {}
+
+    def __hash__(self):
+        return hash(self.__key)
+
+    def __eq__(self, other):
+        return self is other or (other.__class__ == CharacterClass and self.__key == other.__key)
+
+    def __repr__(self):
+        parts = []
+        if self.__characters:
+            parts.append(repr(''.join(sorted(self.__characters))))
+        if self.__ranges:
+            parts.append('ranges={}'.format(repr(self.__ranges)))
+        if self.__categories:
+            parts.append('categories={}'.format(repr(tuple(sorted(self.__categories)))))
+        if self.__predicate is not None:
+            parts.append('predicate={}'.format(repr(self.__predicate)))
+        return 'CharacterClass({})'.format(', '.join(parts))
+
+    def __contains__(self, char):
+        try:
+            return self.__memo[char]
+        except KeyError:
+            pass
+        contained = char in self.__characters or \
+            any(low <= char <= high for low, high in self.__ranges) or \
+            (self.__categories and self.__is_in_categories(char)) or \
+            (self.__predicate is not None and bool(self.__predicate(char)))
+        self.__memo[char] = contained
+        return contained
+
+    def __is_in_categories(self, char):
+        from unicodedata import category
+
+        char_category = category(char)
+        return char_category in self.__categories or char_category[0] in self.__categories
+
+
+def _matches(terminal, symbol):
+    if terminal.__class__ == CharacterClass:
+        return symbol.__class__ == str and len(symbol) == 1 and symbol in terminal
+    return terminal == symbol
+
+
+class _GrammarKey:
+    __slots__ = ['rule_sets', 'hash', 'lexer']
+
+    def __init__(self, rule_sets, hash_, lexer):
+        self.rule_sets = rule_sets
+        self.hash = hash_
+        self.lexer = lexer
+
+    def __hash__(self):
+        return self.hash
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if self.hash != other.hash or self.lexer is not other.lexer or len(self.rule_sets) != len(other.rule_sets):
+            return False
+        return all(other.rule_sets.get(head) == rule_set for head, rule_set in self.rule_sets.items())
+
+
+_interned_grammars = _weakref.WeakValueDictionary()
+_transform_cache_generation = 0
+
+
+def clear_transform_cache():
+    """Forget the grammars memoised by Grammar.transform, for when transforms depend on something that changed, such as
+    files they read."""
+    global _transform_cache_generation
+    _transform_cache_generation += 1
+
+
+_rule_ids = _itertools.count()
+
+# Tells states given by Grammar.Analysis.get_state apart from those of other versions of the analysis.
+_ANALYSIS_STATE_VERSION = 1
+
+# Tells files written by Grammar.dump apart from those of other versions of pearl.
+_GRAMMAR_DUMP_VERSION = 1
+
+# Callables registered by name, and their names.
+_actions = {}
+_action_names = {}
+
+
+def register_action(name, action):
+    """Register action, a build result, grammar transform or any other callable, under name, by which grammars written
+    by Grammar.dump refer to it. Returns action."""
+    registered_action = _actions.get(name)
+    if registered_action is not None and registered_action is not action:
+        raise ValueError('Another action is registered as {!r}'.format(name))
+    _actions[name] = action
+    _action_names[action] = name
+    return action
+
+
+class _ActionPickler(_pickle.Pickler):
+    def persistent_id(self, obj):
+        try:
+            return _action_names.get(obj)
+        except TypeError:
+            return None
+
+
+class _ActionUnpickler(_pickle.Unpickler):
+    def persistent_load(self, name):
+        try:
+            return _actions[name]
+        except KeyError:
+            raise _pickle.UnpicklingError('No action is registered as {!r}'.format(name)) from None
+
+
+class _Located:
+    __slots__ = ['build_result', 'skip']
+
+    def __init__(self, build_result, skip):
+        self.build_result = build_result
+        self.skip = skip
+
+    def __call__(self, *arguments):
+        return self.build_result(*arguments)
+
+    def get_positions(self, text, start, stop):
+        if self.skip is not None and text.__class__ == _TextBuffer:
+            start = text.skip(self.skip, start, stop)
+        return text.get_position(start), text.get_position(stop)
+
+
+def located(build_result, skip=None):
+    """Build result calling build_result with the positions where the match of its rule starts and stops, as reported in
+    parse errors, followed by the selected arguments. When parsing text, the start is taken after what the compiled
+    regular expression skip matches at the start of the match, such as whitespace; the text of the match is then kept
+    until the result is built."""
+    assert callable(build_result)
+    return _Located(build_result, skip)
 
 
 class Grammar:
-    class Rule(_namedtuple('Rule', ['head', 'body', 'grammar_transforms', 'argument_selectors', 'build_result'])):
+    """Immutable set of rules.
+
+    Grammars are interned: building a grammar with the same rules and lexer as a live one gives back that very object,
+    so grammars compare by identity. Rules are the same if their build results and grammar transforms are the same
+    objects too.
+    """
+
+    class Rule(_namedtuple('Rule', ['head', 'body', 'grammar_transforms', 'argument_selectors', 'build_result', 'id'])):
         @property
         def __key(self):
             return self.head, self.body
@@ -14,41 +399,278 @@ class Grammar:
         def __eq__(self, other):
             return self is other or self.__key == other.__key
 
-    def __init__(self, *, _rule_sets={}):
-        self.__rule_sets = _rule_sets
-        self.__cached_key = None
-        self.__cached_hash = None
+        # Rules compare by head and body, so that putting a rule replaces the one it is equal to. Grammars are interned
+        # by their rules along with their actions, which are told apart by identity.
+
+        @property
+        def __actions(self):
+            return (self.build_result,) + tuple(_itertools.chain.from_iterable(self.grammar_transforms))
+
+        @property
+        def full_hash(self):
+            """Hash of the head, the body, the argument selectors and the identities of the actions."""
+            return hash((self.__key, self.argument_selectors, tuple(map(id, self.__actions))))
+
+        def has_same_actions(self, other):
+            actions = self.__actions
+            other_actions = other.__actions
+            return (self.argument_selectors == other.argument_selectors and len(actions) == len(other_actions)
+                    and all(a is b for a, b in zip(actions, other_actions)))
+
+    class Analysis:
+        """Nullable symbols, FIRST sets and lookahead-indexed predictions of a grammar.
+
+        Rules whose grammar transforms run before their first terminal is known are opaque: they are treated as
+        nullable and as possibly starting with anything, since the grammar they continue in is not this one.
+        """
+
+        def __init__(self, rule_sets, state=None):
+            self.__rule_sets = rule_sets
+            self.__prediction_tables = {}
+            # Number of times the analysis was made or gained a prediction, other than from a state.
+            self.change_count = 0 if state is not None else 1
+
+            if state is not None:
+                _, self.__nullable, self.__opaque, self.__first, _ = state
+                self.restore_predictions(state)
+                return
+
+            nullable = set()
+            opaque = set()
+            first = {head: set() for head in rule_sets}
+            changed = True
+            while changed:
+                changed = False
+                for head, rule_set in rule_sets.items():
+                    for rule in rule_set:
+                        rule_first, rule_nullable, rule_opaque = self.__scan_rule(rule, nullable, opaque, first)
+                        if rule_opaque and head not in opaque:
+                            opaque.add(head)
+                            changed = True
+                        if (rule_nullable or rule_opaque) and head not in nullable:
+                            nullable.add(head)
+                            changed = True
+                        if not rule_first <= first[head]:
+                            first[head] |= rule_first
+                            changed = True
+
+            self.__nullable = frozenset(nullable)
+            self.__opaque = frozenset(opaque)
+            self.__first = {head: frozenset(symbols) for head, symbols in first.items()}
+
+        def __scan_rule(self, rule, nullable, opaque, first):
+            rule_first = set()
+            for i, symbol in enumerate(rule.body):
+                if rule.grammar_transforms[i]:
+                    return rule_first, False, True
+                if symbol not in self.__rule_sets:
+                    rule_first.add(symbol)
+                    return rule_first, False, False
+                if symbol in opaque:
+                    return rule_first, False, True
+                rule_first |= first[symbol]
+                if symbol not in nullable:
+                    return rule_first, False, False
+            return rule_first, True, False
+
+        @property
+        def nullable(self):
+            return self.__nullable
+
+        def first(self, symbol):
+            """Terminals a derivation of symbol can start with, or None if that can't be known in advance."""
+            if symbol not in self.__rule_sets:
+                return frozenset({symbol})
+            if symbol in self.__opaque:
+                return None
+            return self.__first[symbol]
+
+        def predict(self, head, next_symbol):
+            """Rules of head that can start a derivation when the upcoming input symbol is next_symbol."""
+            try:
+                rule_firsts, table = self.__prediction_tables[head]
+            except KeyError:
+                rule_firsts, table = None, {}
+            try:
+                return table[next_symbol]
+            except KeyError:
+                pass
+            # Tables restored from a state lack the FIRST sets of the rules until a lookahead misses.
+            if rule_firsts is None:
+                rule_firsts = []
+                for rule in self.__rule_sets.get(head, ()):
+                    rule_first, rule_nullable, rule_opaque = self.__scan_rule(rule, self.__nullable, self.__opaque, self.__first)
+                    rule_firsts.append((rule, None if rule_nullable or rule_opaque else rule_first))
+                self.__prediction_tables[head] = rule_firsts, table
+            rules = tuple(rule for rule, rule_first in rule_firsts
+                          if rule_first is None or any(_matches(t, next_symbol) for t in rule_first))
+            table[next_symbol] = rules
+            self.change_count += 1
+            return rules
+
+        def restore_predictions(self, state):
+            """Take the predictions of the heads that have none yet from state, the state of an analysis of a grammar
+            with the same rules."""
+            tables = {}
+            for head, table in state[4].items():
+                if head in self.__prediction_tables:
+                    continue
+                rules = {rule.body: rule for rule in self.__rule_sets.get(head, ())}
+                tables[head] = None, {symbol: tuple(rules[body] for body in bodies) for symbol, bodies in table.items()}
+            self.__prediction_tables.update(tables)
+
+        def get_state(self):
+            """Picklable state of the analysis, including the predictions made so far."""
+            predictions = {head: {symbol: tuple(rule.body for rule in rules) for symbol, rules in table.items()}
+                           for head, (_, table) in self.__prediction_tables.items()}
+            return _ANALYSIS_STATE_VERSION, self.__nullable, self.__opaque, self.__first, predictions
+
+    def __new__(cls, *, _rule_sets=_HashTrie(), _hash=0, _lexer=None):
+        key = _GrammarKey(_rule_sets, _hash, _lexer)
+        self = _interned_grammars.get(key)
+        if self is None:
+            self = super().__new__(cls)
+            self.__rule_sets = _rule_sets
+            self.__hash = _hash
+            self.__lexer = _lexer
+            self.__analysis = None
+            self.__fingerprint = None
+            self.__transforms = {}
+            _interned_grammars[key] = self
+        return self
 
     @property
-    def __key(self):
-        if self.__cached_key is None:
-            self.__cached_key = frozenset(self.__rule_sets.values())
-        return self.__cached_key
+    def lexer(self):
+        """Lexer that text is split into tokens with before parsing, or None to parse it character by character."""
+        return self.__lexer
+
+    def with_lexer(self, lexer):
+        assert lexer is None or lexer.__class__ == Lexer
+        return Grammar(_rule_sets=self.__rule_sets, _hash=self.__hash, _lexer=lexer)
+
+    @property
+    def analysis(self):
+        if self.__analysis is None:
+            self.__analysis = Grammar.Analysis(self.__rule_sets)
+        return self.__analysis
+
+    @property
+    def analysis_change_count(self):
+        """Number of times the analysis was made or gained a prediction in this process, other than by restore_analysis,
+        which tells whether get_analysis_state has anything new since it was last called."""
+        return 0 if self.__analysis is None else self.__analysis.change_count
+
+    def get_analysis_state(self):
+        """Picklable state of the analysis, including the predictions made so far, or None if it isn't made yet. It can
+        be restored into a grammar with the same fingerprint, possibly in another process, by restore_analysis."""
+        if self.__analysis is None:
+            return None
+        return self.__analysis.get_state()
+
+    def restore_analysis(self, state):
+        """Take the analysis from state, given by get_analysis_state, or only the predictions it lacks if it is already
+        made. Returns whether state was used."""
+        if state[0] != _ANALYSIS_STATE_VERSION or set(state[3]) != set(self.__rule_sets):
+            return False
+        try:
+            if self.__analysis is None:
+                self.__analysis = Grammar.Analysis(self.__rule_sets, state)
+            else:
+                self.__analysis.restore_predictions(state)
+        except KeyError:
+            return False
+        return True
+
+    def dump(self, file):
+        """Write the rules, the lexer and the analysis of the grammar to file, opened for writing bytes, for load to
+        read. Build results, grammar transforms and the lexer are pickled, apart from registered actions, which are
+        written by name, so lambdas and closures must be registered by register_action."""
+        rules = sorted((rule for rule_set in self.__rule_sets.values() for rule in rule_set), key=lambda rule: rule.id)
+        _ActionPickler(file, _pickle.HIGHEST_PROTOCOL).dump((
+            _GRAMMAR_DUMP_VERSION,
+            [(rule.head, Grammar.__get_body_and_grammar_transforms(rule), rule.build_result) for rule in rules],
+            self.__lexer,
+            self.analysis.get_state(),
+        ))
+
+    @staticmethod
+    def load(file):
+        """Grammar written to file by dump, with its analysis. The actions it refers to must be registered under the
+        same names."""
+        version, rules, lexer, analysis_state = _ActionUnpickler(file).load()
+        if version != _GRAMMAR_DUMP_VERSION:
+            raise ValueError('Grammar dumped by another version of pearl')
+        grammar = Grammar().extend(rules).with_lexer(lexer)
+        grammar.restore_analysis(analysis_state)
+        return grammar
+
+    @staticmethod
+    def __get_body_and_grammar_transforms(rule):
+        body_and_grammar_transforms = []
+        for i, symbol in enumerate(rule.body):
+            body_and_grammar_transforms.extend(rule.grammar_transforms[i])
+            body_and_grammar_transforms.append({symbol} if rule.argument_selectors[i] else symbol)
+        body_and_grammar_transforms.extend(rule.grammar_transforms[-1])
+        return body_and_grammar_transforms
+
+    @property
+    def fingerprint(self):
+        """Digest of the heads and bodies of the rules and of where they have grammar transforms, which unlike the hash
+        is the same in every process."""
+        if self.__fingerprint is None:
+            rules = sorted(repr((rule.head, rule.body, tuple(map(bool, rule.grammar_transforms))))
+                           for rule_set in self.__rule_sets.values() for rule in rule_set)
+            self.__fingerprint = _blake2b('\n'.join(rules).encode('UTF-8'), digest_size=16).digest()
+        return self.__fingerprint
 
     def __hash__(self):
-        if self.__cached_hash is None:
-            self.__cached_hash = hash(self.__key)
-        return self.__cached_hash
+        return self.__hash
 
     def __eq__(self, other):
-        return self is other or self.__key == other.__key
+        return self is other
+
+    def transform(self, transform_grammar, *arguments):
+        """transform_grammar(self, *arguments), memoised on hashable arguments since grammar transforms are pure, until
+        clear_transform_cache is called."""
+        key = transform_grammar, arguments
+        try:
+            generation, grammar = self.__transforms[key]
+            if generation == _transform_cache_generation:
+                return grammar
+        except KeyError:
+            pass
+        except TypeError:
+            return self.__call_transform(transform_grammar, arguments)
+        grammar = self.__call_transform(transform_grammar, arguments)
+        assert grammar.__class__ == Grammar
+        self.__transforms[key] = _transform_cache_generation, grammar
+        return grammar
+
+    def __call_transform(self, transform_grammar, arguments):
+        if _active_stats is None:
+            return transform_grammar(self, *arguments)
+        start = _time.perf_counter()
+        grammar = transform_grammar(self, *arguments)
+        _active_stats.add_transform(transform_grammar, _time.perf_counter() - start)
+        return grammar
 
     def __getitem__(self, head):
         assert head.__class__ == str and len(head) > 1
-        return self.__rule_sets.get(head, frozenset())
+        return self.__rule_sets.get(head, _EMPTY_RULE_SET)
 
-    def put(self, head, body_and_grammar_transforms, build_result=None):
+    @staticmethod
+    def __build_rule(head, body_and_grammar_transforms, build_result=None):
         assert head.__class__ == str and len(head) > 1
 
         body = []
         grammar_transforms = [[]]
         argument_selectors = []
         for x in body_and_grammar_transforms:
-            if x.__class__ in (set, str):
+            if x.__class__ in (set, str, CharacterClass):
                 if x.__class__ == set:
                     assert len(x) == 1
                     x = next(iter(x))
-                    assert x.__class__ == str
+                    assert x.__class__ in (str, CharacterClass)
                     argument_selectors.append(True)
                 else:
                     argument_selectors.append(False)
@@ -60,27 +682,57 @@ class Grammar:
                 grammar_transforms[-1].append(x)
 
         assert build_result is None or callable(build_result)
+        # Without build_result, the result is the selected argument, if any, or the text of the match.
+        assert build_result is not None or argument_selectors.count(True) <= 1
+
+        return Grammar.Rule(head, tuple(body), tuple(map(tuple, grammar_transforms)), tuple(argument_selectors), build_result,
+                            next(_rule_ids))
+
+    @staticmethod
+    def __head_hash(head, rule_set):
+        if rule_set is None:
+            return 0
+        return hash((head, hash(rule_set)))
+
+    @staticmethod
+    def __replace_rule_set(rule_sets, hash_, head, rule_set):
+        old_rule_set = rule_sets.get(head)
+        hash_ ^= Grammar.__head_hash(head, old_rule_set) ^ Grammar.__head_hash(head, rule_set)
+        if rule_set is None:
+            return rule_sets.remove(head), hash_
+        return rule_sets.set(head, rule_set), hash_
 
-        rule = Grammar.Rule(head, tuple(body), tuple(map(tuple, grammar_transforms)), tuple(argument_selectors), build_result)
-
-        rule_sets = self.__rule_sets.copy()
-        rule_set = rule_sets.get(rule.head, frozenset())
-        rule_set = frozenset({r for r in rule_set if r != rule} | {rule})
-        rule_sets[rule.head] = rule_set
-        return Grammar(_rule_sets=rule_sets)
+    def put(self, head, body_and_grammar_transforms, build_result=None):
+        return self.extend([(head, body_and_grammar_transforms, build_result)])
+
+    def extend(self, rules):
+        """Put every (head, body_and_grammar_transforms[, build_result]) in rules, without building intermediate grammars."""
+        rule_sets = self.__rule_sets
+        hash_ = self.__hash
+        # Rule sets are replaced once per head rather than once per rule.
+        new_rule_sets = {}
+        for rule in rules:
+            rule = Grammar.__build_rule(*rule)
+            rule_set = new_rule_sets.get(rule.head)
+            if rule_set is None:
+                rule_set = rule_sets.get(rule.head, _EMPTY_RULE_SET)
+            new_rule_sets[rule.head] = rule_set.put(rule)
+        for head, rule_set in new_rule_sets.items():
+            rule_sets, hash_ = Grammar.__replace_rule_set(rule_sets, hash_, head, rule_set)
+        return Grammar(_rule_sets=rule_sets, _hash=hash_, _lexer=self.__lexer)
 
     def drop(self, head, body=None):
-        rule_sets = self.__rule_sets.copy()
         if body is None:
-            rule_sets.pop(head, None)
+            rule_set = None
         else:
             body = tuple(body)
-            rule_set = rule_sets.get(head, frozenset())
-            rule_set = frozenset(r for r in rule_set if r.body != body)
-            rule_sets[head] = rule_set
-        return Grammar(_rule_sets=rule_sets)
+            rule_set = self.__rule_sets.get(head, _EMPTY_RULE_SET).drop(Grammar.Rule(head, body, None, None, None, None))
+        rule_sets, hash_ = Grammar.__replace_rule_set(self.__rule_sets, self.__hash, head, rule_set)
+        return Grammar(_rule_sets=rule_sets, _hash=hash_, _lexer=self.__lexer)
 
     def is_terminal(self, symbol):
+        if symbol.__class__ == CharacterClass:
+            return True
         assert symbol.__class__ == str and symbol
         return symbol not in self.__rule_sets
 
@@ -89,45 +741,321 @@ class _TextSegment(_namedtuple('_TextSegment', ['text', 'start', 'stop'])):
     def __str__(self):
         return self.text[self.start:self.stop]
 
+    @property
+    def value(self):
+        """The covered text, or the tuple of covered tokens when parsing a token stream."""
+        return self.text[self.start:self.stop]
+
+
+class _TextBuffer:
+    """Input received so far, indexed by absolute position. Text before some position can be released once nothing
+    refers to it any more; line starts are kept for error reports."""
+
+    def __init__(self):
+        self.__text = ''
+        self.__chunks = []
+        self.__offset = 0
+        self.__length = 0
+        self.__line_starts = [0]
+
+    def __len__(self):
+        return self.__length
+
+    @property
+    def offset(self):
+        return self.__offset
+
+    def append(self, chunk):
+        i = chunk.find('\n')
+        while i != -1:
+            self.__line_starts.append(self.__length + i + 1)
+            i = chunk.find('\n', i + 1)
+        self.__chunks.append(chunk)
+        self.__length += len(chunk)
+
+    def __getitem__(self, index):
+        assert index.__class__ == slice and index.step is None
+        assert index.start >= self.__offset, 'Text before {} was released'.format(self.__offset)
+        self.__join_chunks()
+        return self.__text[index.start - self.__offset:index.stop - self.__offset]
+
+    def skip(self, pattern, start, stop):
+        """Index after the match of the compiled regular expression pattern at start, not going past stop."""
+        assert start >= self.__offset, 'Text before {} was released'.format(self.__offset)
+        self.__join_chunks()
+        match = pattern.match(self.__text, start - self.__offset, stop - self.__offset)
+        return start if match is None else self.__offset + match.end()
+
+    def __join_chunks(self):
+        if self.__chunks:
+            self.__text = ''.join([self.__text] + self.__chunks)
+            self.__chunks = []
+
+    def release(self, stop):
+        """Forget the text before stop."""
+        if stop > self.__offset:
+            self.__text = self[stop:self.__length]
+            self.__offset = stop
+
+    def get_position(self, index):
+        from bisect import bisect
+
+        line = bisect(self.__line_starts, index) - 1
+        column = index - self.__line_starts[line]
+        return line + 1, column + 1
+
+
+class _TokenBuffer:
+    """Tokens received so far, indexed by absolute position, with the same interface as _TextBuffer."""
+
+    def __init__(self):
+        self.__tokens = []
+        self.__offset = 0
+        self.__positions = []
+        self.end_position = None
+
+    def __len__(self):
+        return len(self.__positions)
+
+    @property
+    def offset(self):
+        return self.__offset
+
+    def append(self, token):
+        self.__tokens.append(token)
+        self.__positions.append(getattr(token, 'position', len(self.__positions) + 1))
+
+    def __getitem__(self, index):
+        assert index.__class__ == slice and index.step is None
+        assert index.start >= self.__offset, 'Tokens before {} were released'.format(self.__offset)
+        return tuple(self.__tokens[index.start - self.__offset:index.stop - self.__offset])
+
+    def release(self, stop):
+        """Forget the tokens before stop."""
+        if stop > self.__offset:
+            del self.__tokens[:stop - self.__offset]
+            self.__offset = stop
+
+    def get_position(self, index):
+        if index < len(self.__positions):
+            return self.__positions[index]
+        if self.end_position is not None:
+            return self.end_position
+        return index + 1
+
+
+class Token(_namedtuple('Token', ['symbol', 'value', 'position'])):
+    """Token produced by a Lexer. Tokens are matched against terminals by symbol; any object with a symbol attribute
+    (and optionally a position for error reports) can be parsed as a token."""
+
+
+class Lexer:
+    """Regular expression based front end that splits text into Tokens before it is parsed.
+
+    rules are (symbol, pattern) or (symbol, pattern, build_value) tuples, tried in order at each position; the first
+    pattern that matches wins. Matches of rules whose symbol is None, such as whitespace and comments, are skipped.
+    """
+
+    def __init__(self, rules):
+        self.__rules = []
+        patterns = []
+        for i, rule in enumerate(rules):
+            symbol, pattern, build_value = (tuple(rule) + (None,))[:3]
+            assert symbol is None or (symbol.__class__ == str and symbol)
+            assert build_value is None or callable(build_value)
+            self.__rules.append((symbol, build_value))
+            patterns.append('(?P<_{}>{})'.format(i, pattern))
+        self.__pattern = _re.compile('|'.join(patterns))
+
+    def lex(self, text, position=(1, 1)):
+        """Match as much of text as possible. Return the matches as (symbol, value, text, position) tuples, including
+        skipped ones whose symbol is None, along with the index and the position where matching stopped."""
+        matches = []
+        index = 0
+        line, column = position
+        while index < len(text):
+            match = self.__pattern.match(text, index)
+            if match is None or match.end() == index:
+                break
+            symbol, build_value = self.__rules[int(match.lastgroup[1:])]
+            match_text = match.group()
+            value = match_text if build_value is None else build_value(match_text)
+            matches.append((symbol, value, match_text, (line, column)))
+            newlines = match_text.count('\n')
+            if newlines:
+                line += newlines
+                column = len(match_text) - match_text.rfind('\n')
+            else:
+                column += len(match_text)
+            index = match.end()
+        return matches, index, (line, column)
+
+    def tokenize(self, text, position=(1, 1)):
+        """Split the whole of text into Tokens, skipping ignored matches."""
+        matches, index, stop_position = self.lex(text, position)
+        if index < len(text):
+            raise ParseError('Got {} at {}. Expected a token'.format(repr(text[index]), stop_position))
+        return [Token(symbol, value, position) for symbol, value, _, position in matches if symbol is not None]
+
+
+_interned_deferred_results = _weakref.WeakValueDictionary()
+
+
+class _DeferredResult:
+    """Result of build_result(*arguments), built only when forced. Deferred results are interned, so they compare by
+    identity and share their value once it is built."""
+
+    __slots__ = ['build_result', 'arguments', 'value', '__hash', '__weakref__']
+
+    def __new__(cls, build_result, arguments):
+        key = build_result, arguments
+        self = _interned_deferred_results.get(key)
+        if self is None:
+            self = super().__new__(cls)
+            self.build_result = build_result
+            self.arguments = arguments
+            self.value = _MISSING
+            self.__hash = hash(key)
+            _interned_deferred_results[key] = self
+        return self
+
+    def __hash__(self):
+        return self.__hash
+
+    def __eq__(self, other):
+        return self is other
+
+    @property
+    def dependencies(self):
+        return self.arguments
+
+    def build(self):
+        arguments = [a.value if a.__class__ == _TextSegment else a for a in map(_force, self.arguments)]
+        return self.build_result(*arguments)
+
+
+class _DeferredCompletion:
+    """Result that completing through the Leo chain leo with item_result at index brings, found only when forced."""
+
+    __slots__ = ['leo', 'item_result', 'text', 'index', 'value', '__result', '__hash']
+
+    def __init__(self, leo, item_result, text, index):
+        self.leo = leo
+        self.item_result = item_result
+        self.text = text
+        self.index = index
+        self.value = _MISSING
+        self.__result = _MISSING
+        self.__hash = hash((id(leo), item_result, index))
+
+    def __hash__(self):
+        return self.__hash
+
+    def __eq__(self, other):
+        return self is other or (other.__class__ == _DeferredCompletion and self.leo is other.leo and
+                                 self.index == other.index and self.item_result == other.item_result)
+
+    @property
+    def dependencies(self):
+        if self.__result is _MISSING:
+            self.__result = _walk_leo(self.leo, self.item_result, self.text, self.index)
+        return self.__result,
+
+    def build(self):
+        return _force(self.dependencies[0])
+
+
+_DEFERRED_CLASSES = _DeferredResult, _DeferredCompletion
+
+
+def _force(result):
+    """Value of result, building the deferred results it depends on bottom-up, without recursion."""
+    if result.__class__ not in _DEFERRED_CLASSES:
+        return result
+    stack = [result]
+    while stack:
+        deferred = stack[-1]
+        if deferred.value is not _MISSING:
+            stack.pop()
+            continue
+        pending = [d for d in deferred.dependencies if d.__class__ in _DEFERRED_CLASSES and d.value is _MISSING]
+        if pending:
+            stack.extend(pending)
+            continue
+        deferred.value = deferred.build()
+        stack.pop()
+    return result.value
+
 
 class _Item:
+    """Earley item whose child results are kept as a chain through the items it was consumed from.
+
+    The item before the last consumption is canonical within its Earley set, so it stands for the whole prefix of
+    child results: items are identified by it and the last child result, and consuming a child takes constant time.
+    Items that run grammar transforms keep their child results, with selected text turned into strings.
+    """
+
+    deferred = False
+
     __slots__ = [
         '__start',
         '__parent_items',
         '__grammar',
         '__rule',
+        '__progress',
+        '__previous',
+        '__child_result',
         '__child_results',
         '__cached_key',
         '__cached_hash',
     ]
 
-    def __init__(self, start, parent_items, grammar, rule, child_results):
-        grammar_transforms = rule.grammar_transforms[len(child_results)]
+    def __init__(self, start, parent_items, grammar, rule, previous=None, child_result=None):
+        self.__start = start
+        self.__parent_items = parent_items
+        self.__rule = rule
+        self.__previous = previous
+        self.__child_result = child_result
+        if previous is None:
+            self.__progress = 0
+            self.__child_results = ()
+        else:
+            self.__progress = previous.__progress + 1
+            self.__child_results = None
+        self.__cached_key = None
+        self.__cached_hash = None
+
+        grammar_transforms = rule.grammar_transforms[self.__progress]
         if grammar_transforms:
             selected_arguments = []
-            new_child_results = []
-            for child_result, selected in zip(child_results, rule.argument_selectors):
+            child_results = []
+            for child_result, selected in zip(self.__get_child_results(), rule.argument_selectors):
                 if selected:
+                    child_result = _force(child_result)
                     if child_result.__class__ == _TextSegment:
-                        child_result = str(child_result)
+                        child_result = child_result.value
                     selected_arguments.append(child_result)
-                new_child_results.append(child_result)
-            child_results = tuple(new_child_results)
+                child_results.append(child_result)
+            self.__child_results = tuple(child_results)
             for transform_grammar in grammar_transforms:
-                grammar = transform_grammar(grammar, *selected_arguments)
+                grammar = grammar.transform(transform_grammar, *selected_arguments)
 
-        self.__start = start
-        self.__parent_items = parent_items
         self.__grammar = grammar
-        self.__rule = rule
-        self.__child_results = child_results
-        self.__cached_key = None
-        self.__cached_hash = None
+
+    def __get_child_results(self):
+        child_results = []
+        item = self
+        while item.__child_results is None:
+            child_results.append(item.__child_result)
+            item = item.__previous
+        child_results.reverse()
+        return item.__child_results + tuple(child_results)
 
     @property
     def __key(self):
         if self.__cached_key is None:
-            self.__cached_key = id(self.__parent_items), self.__grammar, self.__rule, self.__child_results
+            self.__cached_key = (id(self.__parent_items), self.__grammar, self.__rule.id, id(self.__previous),
+                                 self.__child_result)
         return self.__cached_key
 
     def __hash__(self):
@@ -154,22 +1082,46 @@ class _Item:
     def rule(self):
         return self.__rule
 
+    @property
+    def text_start(self):
+        """Earliest input position that results built from this item may still refer to, or None if there is none."""
+        text_start = None
+        build_result = self.__rule.build_result
+        if (build_result is None and not any(self.__rule.argument_selectors)) or \
+                (build_result.__class__ == _Located and build_result.skip is not None):
+            text_start = self.__start
+        for child_result, selected in zip(self.__get_child_results(), self.__rule.argument_selectors):
+            if selected and child_result.__class__ == _TextSegment and (text_start is None or child_result.start < text_start):
+                text_start = child_result.start
+        return text_start
+
     def get_result(self, text, stop):
         assert self.is_complete
-        selected_arguments = [a for a, s in zip(self.__child_results, self.__rule.argument_selectors) if s]
+        return self.__build_result(self.__get_child_results(), text, stop)
+
+    def get_result_with(self, next_child_result, text, stop):
+        """Result that consuming next_child_result would complete this item with, without making that item."""
+        assert self.progress == len(self.__rule.body) - 1 and not self.__rule.grammar_transforms[-1]
+        return self.__build_result(self.__get_child_results() + (next_child_result,), text, stop)
+
+    def __build_result(self, child_results, text, stop):
+        selected_arguments = [a for a, s in zip(child_results, self.__rule.argument_selectors) if s]
         if self.__rule.build_result:
             for i, selected_argument in enumerate(selected_arguments):
                 if selected_argument.__class__ == _TextSegment:
-                    selected_arguments[i] = str(selected_argument)
+                    selected_arguments[i] = selected_argument.value
+            if self.__rule.build_result.__class__ == _Located:
+                selected_arguments[:0] = self.__rule.build_result.get_positions(text, self.__start, stop)
+            if self.deferred:
+                return _DeferredResult(self.__rule.build_result, tuple(selected_arguments))
             return self.__rule.build_result(*selected_arguments)
         if len(selected_arguments) == 0:
             return _TextSegment(text, self.__start, stop)
-        assert len(selected_arguments) == 1 or print(selected_arguments)
         return selected_arguments[0]
 
     @property
     def progress(self):
-        return len(self.__child_results)
+        return self.__progress
 
     @property
     def is_complete(self):
@@ -182,35 +1134,484 @@ class _Item:
 
     def consume(self, next_child_result):
         assert not self.is_complete
-        return _Item(self.__start, self.__parent_items, self.__grammar, self.rule, self.__child_results + (next_child_result,))
+        return self.__class__(self.__start, self.__parent_items, self.__grammar, self.__rule, self, next_child_result)
+
+    def predict(self, start, parent_items, rule):
+        return self.__class__(start, parent_items, self.__grammar, rule)
+
+    def merge(self, other):
+        pass
+
+
+class _DeferredItem(_Item):
+    """_Item whose rules build _DeferredResults, for parse(..., deferred=True)."""
+
+    __slots__ = []
+
+    deferred = True
+
+
+class _ForestItem:
+    """Earley item identified only by its rule, progress, origin and grammar, whose derivations are kept as a list of
+    (predecessor item, child) families forming a shared packed parse forest.
+
+    Grammar transforms see the derivations known at the time the dot reaches them, and their arguments must be
+    unambiguous.
+    """
+
+    deferred = False
+
+    __slots__ = [
+        '__start',
+        '__parent_items',
+        '__grammar',
+        '__rule',
+        '__progress',
+        '__families',
+        '__family_ids',
+        '__text',
+        '__stop',
+        '__cached_key',
+        '__cached_hash',
+    ]
+
+    def __init__(self, start, parent_items, grammar, rule, progress=0, family=None):
+        self.__start = start
+        self.__parent_items = parent_items
+        self.__rule = rule
+        self.__progress = progress
+        self.__families = []
+        self.__family_ids = set()
+        self.__text = None
+        self.__stop = None
+        self.__cached_key = None
+        self.__cached_hash = None
+
+        if family is not None:
+            self.__add_family(family)
+
+        grammar_transforms = rule.grammar_transforms[progress]
+        if grammar_transforms:
+            selected_arguments = {tuple(_selected_arguments(rule, children, progress))
+                                  for children in _evaluate_forest([self])[0][id(self)]}
+            if len(selected_arguments) != 1:
+                raise AmbiguousParse('Ambiguous grammar transform arguments {} in {}'.format(
+                    repr(selected_arguments), repr(rule.head)))
+            selected_arguments, = selected_arguments
+            for transform_grammar in grammar_transforms:
+                grammar = grammar.transform(transform_grammar, *selected_arguments)
+
+        self.__grammar = grammar
+
+    def __add_family(self, family):
+        previous_item, child = family
+        family_id = id(previous_item), id(child)
+        if family_id not in self.__family_ids:
+            self.__family_ids.add(family_id)
+            self.__families.append(family)
+
+    @property
+    def __key(self):
+        if self.__cached_key is None:
+            self.__cached_key = id(self.__parent_items), self.__grammar, self.__rule, self.__progress
+        return self.__cached_key
+
+    def __hash__(self):
+        if self.__cached_hash is None:
+            self.__cached_hash = hash(self.__key)
+        return self.__cached_hash
+
+    def __eq__(self, other):
+        return self is other or self.__key == other.__key
+
+    @property
+    def start(self):
+        return self.__start
+
+    @property
+    def stop(self):
+        return self.__stop
+
+    @property
+    def text(self):
+        return self.__text
+
+    @property
+    def parent_items(self):
+        return self.__parent_items
+
+    @property
+    def grammar(self):
+        return self.__grammar
+
+    @property
+    def rule(self):
+        return self.__rule
+
+    @property
+    def families(self):
+        return self.__families
+
+    def get_result(self, text, stop):
+        assert self.is_complete
+        self.__text = text
+        self.__stop = stop
+        return self
+
+    @property
+    def progress(self):
+        return self.__progress
+
+    @property
+    def is_complete(self):
+        return self.__progress == len(self.__rule.body)
+
+    @property
+    def expected_symbol(self):
+        assert not self.is_complete
+        return self.__rule.body[self.__progress]
+
+    def consume(self, next_child_result):
+        assert not self.is_complete
+        return _ForestItem(self.__start, self.__parent_items, self.__grammar, self.__rule, self.__progress + 1, (self, next_child_result))
+
+    def predict(self, start, parent_items, rule):
+        return _ForestItem(start, parent_items, self.__grammar, rule)
+
+    def merge(self, other):
+        for family in other.__families:
+            self.__add_family(family)
+
+
+def _selected_arguments(rule, children, progress):
+    for i, (child, selected) in enumerate(zip(children, rule.argument_selectors)):
+        if selected:
+            if child.__class__ == _TextSegment and any(rule.grammar_transforms[i + 1:progress + 1]):
+                child = child.value
+            yield child
+
+
+def _build_forest_result(item, children):
+    rule = item.rule
+    selected_arguments = list(_selected_arguments(rule, children, len(children)))
+    if rule.build_result:
+        for i, selected_argument in enumerate(selected_arguments):
+            if selected_argument.__class__ == _TextSegment:
+                selected_arguments[i] = selected_argument.value
+        if rule.build_result.__class__ == _Located:
+            selected_arguments[:0] = rule.build_result.get_positions(item.text, item.start, item.stop)
+        return rule.build_result(*selected_arguments)
+    if len(selected_arguments) == 0:
+        return _TextSegment(item.text, item.start, item.stop)
+    return selected_arguments[0]
+
+
+def _forest_dependencies(item):
+    for previous_item, child in item.families:
+        yield previous_item
+        if child.__class__ == _ForestItem:
+            yield child
+
+
+def _forest_postorder(roots):
+    """Yield the items reachable from roots, each after the items its derivations depend on. Cyclic dependencies are
+    cut, so derivations going around a cycle are ignored."""
+    done = set()
+    for root in roots:
+        if id(root) in done:
+            continue
+        done.add(id(root))
+        stack = [(root, _forest_dependencies(root))]
+        while stack:
+            item, dependencies = stack[-1]
+            for dependency in dependencies:
+                if id(dependency) not in done:
+                    done.add(id(dependency))
+                    stack.append((dependency, _forest_dependencies(dependency)))
+                    break
+            else:
+                stack.pop()
+                yield item
+
+
+def _evaluate_forest(roots):
+    """Return the distinct child tuples of every item reachable from roots and the distinct results of the complete
+    ones, both keyed by item identity."""
+    children_sets = {}
+    result_sets = {}
+    for item in _forest_postorder(roots):
+        if item.progress == 0:
+            children_set = {(): None}
+        else:
+            children_set = {}
+            for previous_item, child in item.families:
+                if child.__class__ != _ForestItem:
+                    child_results = (child,)
+                else:
+                    child_results = result_sets.get(id(child), ())
+                for previous_children in children_sets.get(id(previous_item), ()):
+                    for child_result in child_results:
+                        children_set[previous_children + (child_result,)] = None
+        children_sets[id(item)] = children_set
+        if item.is_complete and item.stop is not None:
+            result_set = {}
+            for children in children_set:
+                result_set[_build_forest_result(item, children)] = None
+            result_sets[id(item)] = result_set
+    return children_sets, result_sets
+
+
+class Forest:
+    """Shared packed parse forest holding every derivation of a parse, as returned by parse(..., output='forest')."""
+
+    def __init__(self, roots):
+        self.__roots = tuple(roots)
+
+    @property
+    def roots(self):
+        return self.__roots
+
+    def count(self):
+        """Number of derivations, not counting ones that go around a cycle."""
+        counts = {}
+        for item in _forest_postorder(self.__roots):
+            if item.progress == 0:
+                count = 1
+            else:
+                count = 0
+                for previous_item, child in item.families:
+                    child_count = 1 if child.__class__ != _ForestItem else counts.get(id(child), 0)
+                    count += counts.get(id(previous_item), 0) * child_count
+            counts[id(item)] = count
+        return sum(counts[id(root)] for root in self.__roots)
+
+    def evaluate(self):
+        """Distinct results of all derivations, each node evaluated once."""
+        _, result_sets = _evaluate_forest(self.__roots)
+        results = set()
+        for root in self.__roots:
+            results.update(result_sets[id(root)])
+        return results
+
+    def __iter__(self):
+        """Lazily yield the result of each derivation, one per derivation."""
+        for root in self.__roots:
+            yield from _run_iteration(_iterate_results(root, set()))
+
+
+class _Iterate:
+    """Request, yielded by the iterations below, for the next value of another one, which is sent back, or _EXHAUSTED.
+    _run_iteration resumes them from an explicit stack, so deep forests don't exhaust the Python one."""
+    __slots__ = ['iteration']
+
+    def __init__(self, iteration):
+        self.iteration = iteration
+
+
+_EXHAUSTED = object()
+
+
+def _run_iteration(iteration):
+    stack = [iteration]
+    value = None
+    while True:
+        try:
+            output = stack[-1].send(value)
+        except StopIteration:
+            stack.pop()
+            if not stack:
+                return
+            value = _EXHAUSTED
+            continue
+        if output.__class__ == _Iterate:
+            stack.append(output.iteration)
+            value = None
+        elif len(stack) == 1:
+            yield output
+            value = None
+        else:
+            stack.pop()
+            value = output
+
+
+def _iterate_children(item, active):
+    if item.progress == 0:
+        yield ()
+        return
+    for previous_item, child in item.families:
+        previous_children_iteration = _iterate_children(previous_item, active)
+        while True:
+            previous_children = yield _Iterate(previous_children_iteration)
+            if previous_children is _EXHAUSTED:
+                break
+            if child.__class__ != _ForestItem:
+                yield previous_children + (child,)
+                continue
+            child_results = _iterate_results(child, active)
+            while True:
+                child_result = yield _Iterate(child_results)
+                if child_result is _EXHAUSTED:
+                    break
+                yield previous_children + (child_result,)
+
+
+def _iterate_results(item, active):
+    if id(item) in active:
+        return
+    active.add(id(item))
+    try:
+        children_iteration = _iterate_children(item, active)
+        while True:
+            children = yield _Iterate(children_iteration)
+            if children is _EXHAUSTED:
+                return
+            yield _build_forest_result(item, children)
+    finally:
+        active.discard(id(item))
+
+
+class _ItemSet(dict):
+    """Items of an Earley set expecting the same symbol, each mapped to itself."""
+
+    __slots__ = ['leo']
+
+
+class _LeoText(_namedtuple('_LeoText', ['start', 'rest', 'target'])):
+    """Link of a Leo chain whose result is the text it covers, starting at start."""
+
+
+class _LeoBuild(_namedtuple('_LeoBuild', ['item', 'rest', 'target'])):
+    """Link of a Leo chain whose result item builds from the result of the link below."""
+
+
+def _get_leo(parent_items):
+    """Chain of deterministic completions above parent_items once their Earley set is closed, or None.
+
+    Right recursion makes completion chains: parent_items holds a single item with only the child left to go, its own
+    parent items likewise, and so on. Following Leo, such a chain is walked without making its complete items: a run
+    of links whose results are just the text they cover is crossed in one step, the others build their results
+    directly from the one below. The chain ends in the items that the topmost link completes into.
+    """
+    chain = []
+    while True:
+        try:
+            leo = parent_items.leo
+            break
+        except AttributeError:
+            pass
+        item = None
+        if len(parent_items) == 1:
+            item, = parent_items
+            rule = item.rule
+            if item.__class__ == _ForestItem or item.parent_items is None or item.progress != len(rule.body) - 1 or \
+                    rule.grammar_transforms[-1]:
+                item = None
+        if item is None:
+            leo = parent_items.leo = None
+            break
+        chain.append((parent_items, item))
+        parent_items = item.parent_items
+    for parent_items, item in reversed(chain):
+        if leo is None:
+            rest = target = item.parent_items
+        else:
+            rest = leo
+            target = leo.target
+        rule = item.rule
+        if rule.build_result is None and not any(rule.argument_selectors):
+            leo = rest if rest.__class__ == _LeoText else _LeoText(item.start, rest, target)
+        else:
+            leo = _LeoBuild(item, rest, target)
+        parent_items.leo = leo
+    return leo
+
+
+def _complete_through_leo(leo, item, text, index):
+    """Result that completing item at index brings to the end of the Leo chain leo, along with the items there.
+
+    For deferred items, the chain is only walked once the result is forced, unless it is a single run of text.
+    """
+    if leo.__class__ == _LeoText:
+        item_result = None
+    else:
+        item_result = item.get_result(text, index)
+    if item.deferred and (leo.__class__ != _LeoText or leo.rest.__class__ != _ItemSet):
+        return leo.target, _DeferredCompletion(leo, item_result, text, index)
+    return leo.target, _walk_leo(leo, item_result, text, index)
+
+
+def _walk_leo(leo, item_result, text, index):
+    while leo.__class__ != _ItemSet:
+        if leo.__class__ == _LeoText:
+            item_result = _TextSegment(text, leo.start, index)
+        else:
+            item_result = leo.item.get_result_with(item_result, text, index)
+        leo = leo.rest
+    return item_result
+
+
+def _get_expectation(symbol, grammar):
+    """Key under which _State indexes the items expecting symbol. Terminals are indexed by themselves so that scanning can
+    look them up; nonterminals are paired with the grammar they are to be derived in, so that a completion only advances
+    the items that predicted it."""
+    if symbol.__class__ == CharacterClass or len(symbol) == 1 or grammar.is_terminal(symbol):
+        return symbol
+    return symbol, grammar
 
 
 class _State:
     def __init__(self):
-        self.__complete = set()
-        self.__expecting = _defaultdict(set)
+        self.__complete = {}
+        self.__expecting = _defaultdict(_ItemSet)
+        self.__character_classes = []
         self.__order = []
+        self.__duplicate_count = 0
 
     def __bool__(self):
         return bool(self.__order)
 
+    def __len__(self):
+        return len(self.__order)
+
     def __iter__(self):
         i = 0
         while i < len(self.__order):
             yield self.__order[i]
             i += 1
 
-    def __getitem__(self, expected_symbol):
-        return self.__expecting[expected_symbol]
+    def __getitem__(self, expectation):
+        return self.__expecting[expectation]
+
+    @property
+    def complete_items(self):
+        return self.__complete
+
+    @property
+    def duplicate_count(self):
+        """Number of items put that were already there."""
+        return self.__duplicate_count
+
+    def scan(self, symbol):
+        """Items expecting a terminal that the input symbol matches."""
+        yield from self.__expecting.get(symbol, ())
+        for character_class in self.__character_classes:
+            if _matches(character_class, symbol):
+                yield from self.__expecting[character_class]
 
     def put(self, item):
         if item.is_complete:
             required_set = self.__complete
         else:
-            required_set = self.__expecting[item.expected_symbol]
-        if item in required_set:
+            expected_symbol = item.expected_symbol
+            if expected_symbol.__class__ == CharacterClass and expected_symbol not in self.__expecting:
+                self.__character_classes.append(expected_symbol)
+            required_set = self.__expecting[_get_expectation(expected_symbol, item.grammar)]
+        existing_item = required_set.get(item)
+        if existing_item is not None:
+            existing_item.merge(item)
+            self.__duplicate_count += 1
             return False
-        required_set.add(item)
+        required_set[item] = item
         self.__order.append(item)
         return True
 
@@ -225,75 +1626,409 @@ class AmbiguousParse(ParseError):
 _END = object()
 
 
-def parse(grammar, text, *, start='__start__', allow_partial=False, allow_ambiguous=True):
-    from itertools import chain
-    from itertools import repeat
+class ParseStats:
+    """Counters of the work done by the parsers it is passed to, as in Parser(..., stats=ParseStats()).
 
-    assert grammar.__class__ == Grammar
-    assert text.__class__ == str
+    Parsers call add_set once per Earley set they close and add_transform once per grammar transform they run, so these
+    can be overridden to observe parsing as it goes. The time of a grammar transform includes any parsing it does.
+    """
 
-    results = set()
+    def __init__(self):
+        self.parses = 0
+        self.scans = 0
+        self.predictions = 0
+        self.completions = 0
+        self.duplicates = 0
+        self.transforms = 0
+        self.transform_seconds = 0.0
+        self.set_sizes = []
+        self.rule_item_counts = _Counter()
+
+    def add_set(self, position, items, kernel_size, duplicates):
+        """Count the Earley set at position, whose first kernel_size items were scanned into it, or started the parse
+        at position 0."""
+        if position == 0:
+            self.parses += 1
+        for i, item in enumerate(items):
+            if i < kernel_size and position != 0:
+                self.scans += 1
+            elif item.progress == 0:
+                self.predictions += 1
+            else:
+                self.completions += 1
+            self.rule_item_counts[item.rule] += 1
+        self.duplicates += duplicates
+        self.set_sizes.append(len(items))
+
+    def add_transform(self, transform_grammar, seconds):
+        self.transforms += 1
+        self.transform_seconds += seconds
+
+    def summary(self, rule_count=10):
+        """Human readable report, listing the rule_count rules with the most items."""
+        item_count = sum(self.set_sizes)
+        lines = [
+            '{} parses, {} Earley sets, {} items'.format(self.parses, len(self.set_sizes), item_count),
+        ]
+        if self.set_sizes:
+            lines.append('items per set: {:.1f} mean, {} max'.format(item_count / len(self.set_sizes), max(self.set_sizes)))
+        lines += [
+            '{} scanned, {} predicted, {} completed, {} duplicates rejected'.format(
+                self.scans, self.predictions, self.completions, self.duplicates),
+            '{} grammar transforms run in {:.3f} s'.format(self.transforms, self.transform_seconds),
+        ]
+        if self.rule_item_counts:
+            lines.append('rules with the most items:')
+            for rule, count in self.rule_item_counts.most_common(rule_count):
+                lines.append('{:>10}  {} -> {}'.format(count, rule.head, ' '.join(map(str, rule.body))))
+        return '\n'.join(lines)
+
+
+_active_stats = None
+
+
+class Parser:
+    """Incremental parser that is fed the input text chunk by chunk.
+
+    Text that no pending derivation can refer to any more is released as parsing goes, except with output='forest' or
+    deferred=True, where results are built from it at the end.
+    """
+
+    def __init__(self, grammar, *, start='__start__', allow_partial=False, allow_ambiguous=True, output='results',
+                 deferred=False, stats=None):
+        assert grammar.__class__ == Grammar
+        assert output in ('results', 'forest')
+        assert stats is None or isinstance(stats, ParseStats)
+
+        self.__allow_partial = allow_partial
+        self.__allow_ambiguous = allow_ambiguous
+        self.__output = output
+        self.__deferred = deferred
+        self.__stats = stats
+        self.__lexer = grammar.lexer
+        self.__lexer_pending_text = ''
+        self.__lexer_pending_position = 1, 1
+        self.__text = None
+        self.__index = 0
+        self.__item_count = 0
+        self.__done = False
+        self.__state = _State()
+
+        if output == 'forest':
+            self.__results = []
+            for rule in grammar[start]:
+                self.__state.put(_ForestItem(0, None, grammar, rule))
+        else:
+            self.__results = set()
+            item_class = _DeferredItem if deferred else _Item
+            for rule in grammar[start]:
+                self.__state.put(item_class(0, None, grammar, rule))
 
-    state = _State()
+    @property
+    def position(self):
+        """Number of characters or tokens consumed so far."""
+        return self.__index
 
-    for rule in grammar[start]:
-        state.put(_Item(0, None, grammar, rule, ()))
+    @property
+    def item_count(self):
+        """Number of items in the Earley sets closed so far, one set per position."""
+        return self.__item_count
 
-    for index, char in enumerate(chain(text, repeat(None))):
-        while True:
-            new_items = False
-            for item in state:
-                if item.is_complete:
-                    if item.parent_items is not None:
-                        item_result = item.get_result(text, index)
-                        for parent_item in item.parent_items:
-                            new_items |= state.put(parent_item.consume(item_result))
-                elif not item.grammar.is_terminal(item.expected_symbol):
-                    for rule in item.grammar[item.expected_symbol]:
-                        new_items |= state.put(_Item(index, state[item.expected_symbol], item.grammar, rule, ()))
-            if not new_items:
-                break
+    @property
+    def expected(self):
+        """Terminals that the next character or token can match."""
+        state = _State()
+        for item in self.__state:
+            state.put(item)
+        _close_state(state, self.__text, self.__index, None, filter_predictions=False)
+        return {item.expected_symbol for item in state if not item.is_complete and item.grammar.is_terminal(item.expected_symbol)}
+
+    def feed(self, chunk):
+        """Feed the next chunk of input: a str, parsed character by character or split into tokens first if the grammar
+        has a lexer, or an iterable of tokens, which are matched against terminals by their symbol attribute."""
+        if self.__done:
+            return
+
+        if chunk.__class__ == str and self.__lexer is None:
+            self.__use_buffer(_TextBuffer).append(chunk)
+            for char in chunk:
+                self.__step(char, char)
+                if self.__done:
+                    return
+        else:
+            if chunk.__class__ == str:
+                chunk = self.__lex(chunk, final=False)
+            text = self.__use_buffer(_TokenBuffer)
+            for token in chunk:
+                text.append(token)
+                self.__step(token.symbol, token)
+                if self.__done:
+                    return
+
+        if self.__output != 'forest' and not self.__deferred:
+            self.__release_text()
+
+    def finish(self, chunk=''):
+        """Signal the end of input and return the set of results, the single result if not allow_ambiguous or the
+        Forest if output='forest'. chunk, if given, is the last chunk of input, which is fed as by feed, knowing that
+        nothing follows it."""
+        if chunk.__class__ != str or self.__lexer is None:
+            self.feed(chunk)
+            chunk = ''
+        if self.__lexer is not None and not self.__done:
+            self.feed(self.__lex(chunk, final=True))
+
+        if self.__text is None:
+            self.__use_buffer(_TokenBuffer if self.__lexer is not None else _TextBuffer)
+
+        if not self.__done:
+            self.__step(None, None)
+
+        if self.__output == 'forest':
+            forest = Forest(self.__results)
+            if not self.__allow_ambiguous and len(forest.evaluate()) > 1:
+                raise AmbiguousParse(forest)
+            return forest
+
+        results = self.__results
+        if self.__deferred:
+            results = set(map(_force, results))
+            if len(results) > 1 and not self.__allow_ambiguous:
+                raise AmbiguousParse(results)
+
+        if not self.__allow_ambiguous:
+            return next(iter(results))
+
+        return results
+
+    def __use_buffer(self, buffer_class):
+        if self.__text is None:
+            self.__text = buffer_class()
+        assert self.__text.__class__ == buffer_class, 'Characters and tokens can\'t be mixed'
+        return self.__text
+
+    def __lex(self, chunk, *, final):
+        text = self.__lexer_pending_text + chunk
+        matches, index, position = self.__lexer.lex(text, self.__lexer_pending_position)
+        if final:
+            if index < len(text):
+                raise ParseError('Got {} at {}. Expected a token'.format(repr(text[index]), position))
+            self.__use_buffer(_TokenBuffer).end_position = position
+        elif matches:
+            # The last match may continue in the next chunk, as may the text after it that doesn't match yet, so it is
+            # matched again together with it. Longer matches spanning the matches before it are missed, such as a
+            # keyword whose shorter tokens were matched before the end of the chunk.
+            _, _, match_text, position = matches.pop()
+            index -= len(match_text)
+        self.__lexer_pending_text = text[index:]
+        self.__lexer_pending_position = position
+        return [Token(symbol, value, position) for symbol, value, _, position in matches if symbol is not None]
+
+    def __step(self, symbol, value):
+        if self.__stats is None:
+            self.__advance(symbol, value)
+            return
+        global _active_stats
+        outer_stats, _active_stats = _active_stats, self.__stats
+        try:
+            self.__advance(symbol, value)
+        finally:
+            _active_stats = outer_stats
+
+    def __advance(self, symbol, value):
+        state = self.__state
+        text = self.__text
+        index = self.__index
+
+        kernel_size = len(state)
+        _close_state(state, text, index, symbol)
+        self.__item_count += len(state)
+        if self.__stats is not None:
+            self.__stats.add_set(index, list(state), kernel_size, state.duplicate_count)
 
         next_state = _State()
 
-        for item in state:
-            if item.is_complete:
+        if self.__allow_partial or symbol is None:
+            for item in state.complete_items:
                 if item.parent_items is None:
-                    if allow_partial or char is None:
-                        item_result = item.get_result(text, index)
-                        results.add(item_result)
-            elif item.grammar.is_terminal(item.expected_symbol) and char is not None:
-                if char == item.expected_symbol:
-                    next_state.put(item.consume(char))
+                    item_result = item.get_result(text, index)
+                    if self.__output == 'forest':
+                        self.__results.append(item_result)
+                    else:
+                        self.__results.add(item_result)
 
-        if len(results) > 1 and not allow_ambiguous:
-            raise AmbiguousParse(results)
+        if symbol is not None:
+            for item in state.scan(symbol):
+                next_state.put(item.consume(value))
+
+        if len(self.__results) > 1 and not self.__allow_ambiguous and self.__output != 'forest' and not self.__deferred:
+            raise AmbiguousParse(self.__results)
 
         if not next_state:
-            if not results:
-                raise ParseError(_build_error_report(text, state, index, char))
-            break
+            if not self.__results:
+                error_state = _State()
+                for item in list(state)[:kernel_size]:
+                    error_state.put(item)
+                _close_state(error_state, text, index, symbol, filter_predictions=False)
+                raise ParseError(_build_error_report(text, error_state, index, value))
+            self.__done = True
+            return
+
+        self.__state = next_state
+        self.__index = index + 1
+
+    def __release_text(self):
+        text_start = self.__index
+        for result in self.__results:
+            if result.__class__ == _TextSegment:
+                text_start = min(text_start, result.start)
+        visited = set()
+        items = list(self.__state)
+        while items:
+            item = items.pop()
+            item_text_start = item.text_start
+            if item_text_start is not None:
+                text_start = min(text_start, item_text_start)
+            parent_items = item.parent_items
+            if parent_items is not None and id(parent_items) not in visited:
+                visited.add(id(parent_items))
+                items.extend(parent_items)
+        self.__text.release(text_start)
+
+
+def parse(grammar, text, *, start='__start__', allow_partial=False, allow_ambiguous=True, output='results',
+          deferred=False, stats=None):
+    """Parse text, a str or an iterable of tokens, and return the set of results, or the single result if not
+    allow_ambiguous.
+
+    With output='forest', return a Forest of all derivations instead, building results only when it is evaluated.
+
+    With deferred=True, build_result is called only for the derivations of the results, once the parse has succeeded,
+    except for the arguments of grammar transforms, which are built as soon as the transforms run, and for derivations
+    going around a cycle of rules, which are built as they are found so that cycles are followed only while they bring
+    new results, as when parsing eagerly. Other derivations with equal results are only merged if their results are
+    built the same way.
+
+    With stats, a ParseStats, count the work done into it.
+    """
+
+    parser = Parser(grammar, start=start, allow_partial=allow_partial, allow_ambiguous=allow_ambiguous, output=output,
+                    deferred=deferred, stats=stats)
+    return parser.finish(text)
+
+
+def _close_state(state, text, index, char, *, filter_predictions=True):
+    predicted = set()
+    null_results = _defaultdict(list)
+    # Nonterminals spanning the same text as deferred items, at or below them, by the ids of the items. Deferred results
+    # are made afresh by every derivation, so derivations going around a cycle never merge by their results, as they do
+    # when parsing eagerly, unless they are built.
+    span_heads = {}
+    for item in state:
+        if item.is_complete:
+            if item.parent_items is not None:
+                parent_items = item.parent_items
+                heads = _get_span_heads(item, span_heads) if item.deferred else None
+                if item.start != index:
+                    leo = _get_leo(parent_items)
+                    # Chains going around a cycle are completed one item at a time instead.
+                    leo_heads = None if leo is None or heads is None else _get_leo_span_heads(leo, item, heads)
+                    if leo is not None and (heads is None or leo_heads is not None):
+                        parent_items, item_result = _complete_through_leo(leo, item, text, index)
+                        if heads is None:
+                            for parent_item in parent_items:
+                                state.put(parent_item.consume(item_result))
+                        else:
+                            _put_deferred_consumptions(state, parent_items, item.start, text, index, item_result,
+                                                       leo_heads, span_heads)
+                        continue
+                item_result = item.get_result(text, index)
+                if item.start == index:
+                    null_results[id(parent_items)].append((item_result, heads))
+                    parent_items = tuple(parent_items)
+                if heads is None:
+                    for parent_item in parent_items:
+                        state.put(parent_item.consume(item_result))
+                else:
+                    _put_deferred_consumptions(state, parent_items, item.start, text, index, item_result, heads,
+                                               span_heads)
+        elif not item.grammar.is_terminal(item.expected_symbol):
+            expected_symbol = item.expected_symbol
+            expectation = _get_expectation(expected_symbol, item.grammar)
+            parent_items = state[expectation]
+            if expectation not in predicted:
+                predicted.add(expectation)
+                if filter_predictions:
+                    rules = item.grammar.analysis.predict(expected_symbol, char)
+                else:
+                    rules = item.grammar[expected_symbol]
+                for rule in rules:
+                    state.put(item.predict(index, parent_items, rule))
+            for item_result, heads in null_results.get(id(parent_items), ()):
+                if heads is None:
+                    state.put(item.consume(item_result))
+                else:
+                    _put_deferred_consumptions(state, (item,), index, text, index, item_result, heads, span_heads)
 
-        state = next_state
 
-    if not allow_ambiguous:
-        return next(iter(results))
+_NO_HEADS = frozenset()
 
-    return results
 
+def _get_span_heads(item, span_heads):
+    """Nonterminals spanning the same text as the complete item, at or below it, none if its result is just text."""
+    rule = item.rule
+    if rule.build_result is None and not any(rule.argument_selectors):
+        return _NO_HEADS
+    return span_heads.get(id(item), _NO_HEADS) | {rule.head}
 
-def _build_error_report(text, state, index, char):
-    from bisect import bisect
 
-    line_starts = [0]
-    for i, c in enumerate(text):
-        if c == '\n':
-            line_starts.append(i + 1)
+def _get_leo_span_heads(leo, item, heads):
+    """Nonterminals spanning the same text as the top of the Leo chain leo that item, with heads, completes through,
+    none if the top spans more text, or None if the chain goes around a cycle."""
+    while leo.__class__ != _ItemSet:
+        if leo.__class__ == _LeoText:
+            if leo.start != item.start:
+                return _NO_HEADS
+            heads = _NO_HEADS
+        else:
+            if leo.item.start != item.start:
+                return _NO_HEADS
+            head = leo.item.rule.head
+            if head in heads:
+                return None
+            heads = heads | {head}
+        leo = leo.rest
+    return heads
+
+
+def _put_deferred_consumptions(state, parent_items, start, text, index, item_result, heads, span_heads):
+    """Put the items that consuming item_result, spanning from start to index with the nonterminals heads spanning the
+    same text, makes of parent_items, except those that complete going around a cycle to a result already found."""
+    for parent_item in parent_items:
+        new_heads = heads if parent_item.start == start else _NO_HEADS
+        if start == index:
+            # The parent item spans the same text as before.
+            new_heads = new_heads | span_heads.get(id(parent_item), _NO_HEADS)
+        new_item = parent_item.consume(item_result)
+        if not new_heads:
+            state.put(new_item)
+        elif not (new_item.is_complete and new_item.rule.head in new_heads and
+                  _repeats_result(state, new_item, text, index)) and state.put(new_item):
+            span_heads[id(new_item)] = new_heads
+
+
+def _repeats_result(state, item, text, index):
+    """Whether the complete item, going around a cycle, builds the result of another complete item of its nonterminal
+    spanning the same text. Like eager parsing, which merges items by their results, this stops going around cycles
+    whose results repeat."""
+    result = _force(item.get_result(text, index))
+    head = item.rule.head
+    return any(other.rule.head == head and other.start == item.start and _force(other.get_result(text, index)) == result
+               for other in state.complete_items)
 
-    def get_position(i):
-        line = bisect(line_starts, i) - 1
-        column = i - line_starts[line]
-        return line + 1, column + 1
+
+def _build_error_report(text, state, index, char):
+    get_position = text.get_position
 
     reports = []
     for item in state:
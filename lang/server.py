@@ -0,0 +1,147 @@
+"""Compile server: a process keeping core_grammar, the modules it read and the grammars they patched in memory, which
+runs the programs its clients ask for over a Unix socket so that they don't pay for starting up.
+
+A request is a line of JSON with the working directory and the arguments of the client. The response is a line of JSON
+for each piece of output, {"stdout": text} or {"stderr": text}, and a last one with the exit status, {"status": code}.
+
+The client only needs this module, so that it starts without importing core.
+"""
+import contextlib
+import io
+import json
+import os
+import socket
+import socketserver
+import stat
+import sys
+import tempfile
+import traceback
+
+
+def get_default_socket_path():
+    """Socket in XDG_RUNTIME_DIR, which only the user can access, or else in a directory of the user's own in the
+    temporary directory, which serve creates accessible to the user only."""
+    runtime_directory = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_directory:
+        return os.path.join(runtime_directory, 'lang-server.sock')
+    return os.path.join(tempfile.gettempdir(), 'lang-server-{}'.format(os.getuid()), 'server.sock')
+
+
+def serve(socket_path, run):
+    """Serve requests on socket_path until interrupted, one at a time. run is called with the arguments of each request
+    in the working directory of its client, and returns the exit status."""
+    connection = _connect(socket_path)
+    if connection is not None:
+        connection.close()
+        raise Exception('A server is already listening on {}'.format(socket_path))
+    directory = os.path.dirname(os.path.abspath(socket_path))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    # makedirs leaves a directory that exists already as it is, which another user could have made, or made a link to
+    # their own, to take the place of the socket.
+    directory_stat = os.lstat(directory)
+    if not stat.S_ISDIR(directory_stat.st_mode) or directory_stat.st_uid != os.getuid() or \
+            directory_stat.st_mode & (stat.S_IRWXG | stat.S_IRWXO):
+        raise Exception('{} must be a directory of the user that only the user can access'.format(directory))
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(socket_path)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            line = self.rfile.readline()
+            # Connections closed without a request, such as those of servers checking for one listening already.
+            if not line:
+                return
+            request = json.loads(str(line, 'UTF-8'))
+            with self.connection.makefile('w', encoding='UTF-8') as file:
+                status = _run_request(run, request['cwd'], request['argv'], file)
+                file.write(json.dumps({'status': status}) + '\n')
+
+    # Requests run as the user of the server, so only the user may connect. The socket is made that way rather than
+    # changed after, when another user could have connected already.
+    umask = os.umask(0o177)
+    try:
+        unix_server = socketserver.UnixStreamServer(socket_path, Handler)
+    finally:
+        os.umask(umask)
+    with unix_server:
+        try:
+            unix_server.serve_forever()
+        finally:
+            os.remove(socket_path)
+
+
+def _run_request(run, cwd, argv, file):
+    os.chdir(cwd)
+    # Programs can't read the input of the client, and mustn't read that of the server.
+    stdin = sys.stdin
+    sys.stdin = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(_Output(file, 'stdout')), contextlib.redirect_stderr(_Output(file, 'stderr')):
+            try:
+                return run(argv)
+            except SystemExit as e:
+                if e.code is None or isinstance(e.code, int):
+                    return e.code or 0
+                print(e.code, file=sys.stderr)
+                return 1
+            except Exception:
+                traceback.print_exc()
+                return 1
+    finally:
+        sys.stdin = stdin
+
+
+class _Output(io.TextIOBase):
+    """Stream of output sent to the client as one of its own, name."""
+
+    def __init__(self, file, name):
+        self.__file = file
+        self.__name = name
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self.__file.write(json.dumps({self.__name: text}) + '\n')
+        return len(text)
+
+    def flush(self):
+        self.__file.flush()
+
+
+def request(socket_path, argv):
+    """Have the server listening on socket_path run argv in the working directory, copying its output to that of this
+    process, and return the exit status, or None if no server is listening there."""
+    connection = _connect(socket_path)
+    if connection is None:
+        return None
+    with connection, connection.makefile('rw', encoding='UTF-8') as file:
+        file.write(json.dumps({'cwd': os.getcwd(), 'argv': argv}) + '\n')
+        file.flush()
+        for line in file:
+            message = json.loads(line)
+            if 'status' in message:
+                return message['status']
+            if 'stdout' in message:
+                sys.stdout.write(message['stdout'])
+            else:
+                sys.stderr.write(message['stderr'])
+    print('The server closed the connection before the request was done', file=sys.stderr)
+    return 1
+
+
+def _connect(socket_path):
+    try:
+        owner = os.stat(socket_path).st_uid
+    except FileNotFoundError:
+        return None
+    # Another user could have made the socket to run what is asked of it, or to read the output.
+    if owner != os.getuid():
+        raise Exception('{} belongs to another user'.format(socket_path))
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        connection.close()
+        return None
+    return connection
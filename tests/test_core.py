@@ -0,0 +1,383 @@
+import contextlib
+import io
+import os.path
+import pickle
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lang'))
+
+import core
+import core.ast
+import pearl
+
+
+def parse(text):
+    return pearl.parse(core.core_grammar, text, allow_ambiguous=False, deferred=True)
+
+
+class CoreGrammarTest(unittest.TestCase):
+    def test_unmacro_core_rules(self):
+        parse('print(1);')
+        with self.assertRaises(pearl.ParseError):
+            parse('unmacro number_literal -> number;\nprint(1);')
+        parse('unmacro number_literal -> number;\nprint(\'1\');')
+        with self.assertRaises(pearl.ParseError):
+            parse('unmacro variable_access -> identifier;\nprint(1);')
+
+    def test_macros_of_characters_extend_identifiers_strings_and_comments(self):
+        body = parse('macro letter -> \'$\', { return 0; }\nvar $a;\nprint(\'$\');\n# $\n')
+        self.assertEqual(body.statements[1], core.ast.VariableDeclaration(False, '$a'))
+        self.assertEqual(body.statements[2].arguments, (core.ast.StringLiteral('$'),))
+        with self.assertRaises(pearl.ParseError):
+            parse('unmacro identifier_head -> letter;\nvar a;')
+        parse('unmacro identifier_head -> letter;\nvar _a;')
+
+    def test_nodes_are_placed_after_whitespace_and_comments(self):
+        body = parse('# a comment\nvar x;\n  # another one\n  x = 1;\n')
+        declaration, assignment = body.statements
+        self.assertIsInstance(declaration, core.ast.VariableDeclaration)
+        self.assertEqual(declaration.position, (2, 1))
+        self.assertEqual(assignment.position, (4, 3))
+        self.assertEqual(assignment.value.position, (4, 7))
+
+    def test_dump_and_load(self):
+        text = 'import \'/std/operators\';\nvar x;\nx = (1 + 2) * 3;\nmacro letter -> \'$\', { return 0; }\nvar $y;\n'
+        file = io.BytesIO()
+        core.core_grammar.dump(file)
+        file.seek(0)
+        grammar = pearl.Grammar.load(file)
+        # Grammars are interned, so the actions of the grammar loaded are those it was dumped with.
+        self.assertIs(grammar, core.core_grammar)
+        self.assertEqual(pearl.parse(grammar, text, allow_ambiguous=False, deferred=True), parse(text))
+
+        action = lambda: None
+        grammar = core.core_grammar.put('statement', ['@'], action)
+        # Which of these pickle raises for functions it can't find by name depends on where they are defined.
+        with self.assertRaises((pickle.PicklingError, AttributeError)):
+            grammar.dump(io.BytesIO())
+        pearl.register_action('test_core.action', action)
+        grammar.dump(io.BytesIO())
+
+
+class ProgramTest(unittest.TestCase):
+    prelude = """
+        import '/std/types';
+        import '/std/io';
+        import '/std/operators';
+        import '/std/if';
+    """
+
+    def run_program(self, text, compiled):
+        """Output of the program, and the class and message of the exception it ended with, if any."""
+        body = parse(self.prelude + text)
+        output = io.StringIO()
+        exception = None
+        with contextlib.redirect_stdout(output):
+            try:
+                if compiled:
+                    body.compile()(core.ast.Context())
+                else:
+                    body.execute(core.ast.Context())
+            except Exception as e:
+                exception = e.__class__, str(e)
+        return output.getvalue(), exception
+
+    def assertRunsAlike(self, text, output, exception=None):
+        """Run the program interpreted and compiled, which must give the same output and exception."""
+        interpreted = self.run_program(text, compiled=False)
+        self.assertEqual(self.run_program(text, compiled=True), interpreted)
+        self.assertEqual(interpreted, (output, exception))
+
+    def test_closures(self):
+        self.assertRunsAlike("""
+            var make;
+            make = (k) => {
+                var total;
+                total = 0;
+                return (x) => { total = total + x * k; return total; };
+            };
+            var a;
+            a = make(3);
+            var b;
+            b = make(10);
+            a(1);
+            b(1);
+            print(a(2), b(2));
+        """, '9.0 30.0\n')
+
+    def test_recursion_and_loops(self):
+        self.assertRunsAlike("""
+            var fib;
+            fib = (n) => {
+                if n.__lt__(2) { return n; }
+                return fib(n - 1) + fib(n - 2);
+            };
+            var i;
+            i = 0;
+            forever {
+                if i.__eq__(6) { return fib(i); }
+                print(fib(i));
+                i = i + 1;
+            }
+        """, '0.0\n1.0\n1.0\n2.0\n3.0\n5.0\n', (core.ast.Return.Exception, '8.0'))
+
+    def test_exceptions(self):
+        self.assertRunsAlike("""
+            print(1);
+            print(x);
+        """, '1.0\n', (Exception, "Use of undeclared variable 'x'"))
+        self.assertRunsAlike("""
+            var f;
+            f = () => { var y; return y; };
+            f();
+        """, '', (Exception, "Use of unassigned variable 'y'"))
+        self.assertRunsAlike("""
+            var f;
+            f = () => { y = 1; };
+            f();
+        """, '', (Exception, "Assignment to undeclared variable 'y'"))
+        self.assertRunsAlike("""
+            var f;
+            f = (a, b) => { return a; };
+            print(f(1));
+        """, '', (TypeError, 'Expected 2 arguments, got 1'))
+        self.assertRunsAlike("""
+            print('a' - 1);
+        """, '', (AttributeError, "'str' object has no attribute '__sub__'"))
+
+
+    def test_shadowing_after_use(self):
+        self.assertRunsAlike("""
+            var x;
+            x = 'outer';
+            var f;
+            f = () => {
+                print(x);
+                var x;
+                x = 'inner';
+                print(x);
+                {
+                    print(x);
+                    var x;
+                    x = 'block';
+                    print(x);
+                }
+                print(x);
+            };
+            f();
+            print(x);
+        """, 'outer\ninner\ninner\nblock\ninner\nouter\n')
+
+    def test_closures_assign_outer_slots(self):
+        self.assertRunsAlike("""
+            var count;
+            count = () => {
+                var n;
+                n = 0;
+                var g;
+                g = () => { n = n + 1; return () => { n = n * 10; }; };
+                g()();
+                g();
+                return n;
+            };
+            print(count());
+            var y;
+            y = 1;
+            {
+                var z;
+                z = 2;
+                { var add; add = () => { y = y + z; z = 0; }; add(); add(); }
+                print(y, z);
+            }
+        """, '11.0\n3.0 0.0\n')
+
+    def test_context_reaches_slots(self):
+        self.assertRunsAlike("""
+            var f;
+            f = (a) => {
+                var b;
+                b = 2;
+                print(__context__.access_variable('a'), __context__.access_variable('b'));
+                __context__.assign_variable('b', 3);
+                print(b);
+                __context__.declare_variable('c');
+                __context__.assign_variable('c', 4);
+                print(c);
+                var c;
+                print(c);
+                c = 5;
+                print(__context__.access_variable('c'));
+            };
+            f(1);
+        """, '1.0 2.0\n3.0\n4.0\n4.0\n5.0\n')
+
+    def test_macros_declaring_variables(self):
+        macro = """
+            macro statement -> whitespace, 'declare', '!', {
+                __usage_context__.declare_variable('m');
+                __usage_context__.assign_variable('m', 'macro');
+            }
+            var m;
+            m = 'outer';
+        """
+        self.assertRunsAlike(macro + """
+            var f;
+            f = () => {
+                declare!
+                print(m);
+                m = 'assigned';
+                print(m);
+            };
+            f();
+            print(m);
+            { declare! print(m); }
+            print(m);
+        """, 'macro\nassigned\nouter\nmacro\nouter\n')
+        # The variable declared by the macro takes the slot of the one declared after it.
+        self.assertRunsAlike(macro + """
+            var f;
+            f = () => {
+                declare!
+                print(m);
+                var m;
+                print(m);
+                m = 'slot';
+                print(m);
+            };
+            f();
+            print(m);
+        """, 'macro\nmacro\nslot\nouter\n')
+
+    # The core grammar has no syntax for break and continue. Expansions give back the nodes, whose completions are
+    # returned, while twice executes its block itself, so that completions are raised through the macro.
+    control_macros = """
+        import '/std/ast';
+        expansion statement -> whitespace, 'brk', '!', { return Break(); }
+        expansion statement -> whitespace, 'cnt', '!', { return Continue(); }
+        expansion statement -> whitespace, 'once', block/b, { return b; }
+        macro statement -> whitespace, 'twice', block/b, {
+            b.execute(__usage_context__);
+            b.execute(__usage_context__);
+        }
+    """
+
+    def test_nested_loops(self):
+        self.assertRunsAlike(self.control_macros + """
+            var out;
+            out = list();
+            var i;
+            i = 0;
+            forever {
+                i = i + 1;
+                if i.__gt__(3) { brk! }
+                if i.__eq__(2) { cnt! }
+                var j;
+                j = 0;
+                forever {
+                    j = j + 1;
+                    if j.__gt__(3) { brk! }
+                    if j.__eq__(i) { cnt! }
+                    out.append(i * 10 + j);
+                }
+            }
+            print(out);
+        """, '[12.0, 13.0, 31.0, 32.0]\n')
+
+    def test_return_from_nested_statements(self):
+        self.assertRunsAlike(self.control_macros + """
+            var f;
+            f = () => { { { return 'nested'; } } };
+            var g;
+            g = (n) => {
+                if n.__lt__(0) { return 'negative'; } else { if n.__eq__(0) { return 'zero'; } }
+                forever { { return 'positive'; } }
+            };
+            var h;
+            h = () => {
+                once { forever { once { return 'expanded'; } } }
+                return 'after';
+            };
+            print(f(), g(- 1), g(0), g(1), h());
+        """, 'nested negative zero positive expanded\n')
+
+    def test_completions_raised_through_macros(self):
+        self.assertRunsAlike(self.control_macros + """
+            var out;
+            out = list();
+            var k;
+            k = 0;
+            forever {
+                k = k + 1;
+                twice {
+                    if k.__eq__(2) { cnt! }
+                    if k.__gt__(3) { brk! }
+                    out.append(k);
+                }
+            }
+            print(out);
+            var br;
+            br = () => { brk! };
+            var m;
+            m = 0;
+            forever { m = m + 1; br(); }
+            print(m);
+            # The function of the macro returns, rather than the one using it.
+            var f;
+            f = () => {
+                var n;
+                n = 0;
+                twice { n = n + 1; return n; }
+                return n * 10;
+            };
+            print(f());
+        """, '[1.0, 1.0, 3.0, 3.0]\n1.0\n10.0\n')
+
+    def test_expansions_are_reused(self):
+        self.assertRunsAlike(self.control_macros + """
+            var calls;
+            calls = list();
+            expansion statement -> whitespace, 'tick', '!', {
+                calls.append(1);
+                return StatementSequence(tuple());
+            }
+            var f;
+            f = () => { tick! };
+            var i;
+            i = 0;
+            forever {
+                i = i + 1;
+                if i.__gt__(5) { brk! }
+                tick!
+                f();
+            }
+            print(calls.__len__());
+        """, '2\n')
+
+    def test_pickling_drops_caches(self):
+        body = parse(self.prelude + self.control_macros + """
+            var i;
+            i = 0;
+            forever { i = i + 1; if i.__gt__(2) { brk! } twice { print(i); } }
+        """)
+        with contextlib.redirect_stdout(io.StringIO()):
+            body.compile()(core.ast.Context())
+        cached = [name for node in walk(body) for name in ('_compiled', '_expansion') if name in node.__dict__]
+        self.assertIn('_compiled', cached)
+        self.assertIn('_expansion', cached)
+        unpickled = pickle.loads(pickle.dumps(body))
+        self.assertEqual(unpickled, body)
+        self.assertFalse([name for node in walk(unpickled) for name in ('_compiled', '_expansion')
+                          if name in node.__dict__])
+
+
+def walk(node):
+    """node and the nodes under it."""
+    yield node
+    for field in node:
+        for child in field if field.__class__ == tuple else (field,):
+            if child.__class__ in core.ast._node_classes:
+                yield from walk(child)
+
+if __name__ == '__main__':
+    unittest.main()
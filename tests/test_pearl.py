@@ -0,0 +1,183 @@
+import os.path
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lang'))
+
+import pearl
+
+
+class GrammarTest(unittest.TestCase):
+    digit = pearl.CharacterClass('0123456789')
+
+    def build_sum(self, add):
+        return pearl.Grammar().put('__start__', [{'number'}, '+', {'number'}], add).put('number', [{self.digit}], int)
+
+    def test_interning_tells_actions_apart(self):
+        add = lambda a, b: a + b
+        self.assertIs(self.build_sum(add), self.build_sum(add))
+        self.assertIsNot(self.build_sum(add), self.build_sum(lambda a, b: a + b))
+        self.assertEqual(pearl.parse(self.build_sum(add), '1+2'), {3})
+        self.assertEqual(pearl.parse(self.build_sum(lambda a, b: str(a) + str(b)), '1+2'), {'12'})
+
+    def test_put_replaces_actions(self):
+        add = lambda a, b: a + b
+        grammar = self.build_sum(lambda a, b: a - b).put('__start__', [{'number'}, '+', {'number'}], add)
+        self.assertIs(grammar, self.build_sum(add))
+        self.assertEqual(len(grammar['__start__']), 1)
+
+
+class ForestTest(unittest.TestCase):
+    def test_iterate_deep_forest(self):
+        grammar = pearl.Grammar().put('list', ['x'], lambda: 1).put('list', ['x', {'list'}], lambda rest: rest + 1)
+        forest = pearl.parse(grammar.put('__start__', [{'list'}]), 'x' * 1500, output='forest')
+        self.assertEqual(list(forest), [1500])
+
+    def test_iterate_ambiguous_forest(self):
+        grammar = pearl.Grammar().put('sum', ['1'], lambda: 1).put(
+            'sum', [{'sum'}, '+', {'sum'}], lambda left, right: (left, right))
+        forest = pearl.parse(grammar.put('__start__', [{'sum'}]), '1+1+1+1+1', output='forest')
+        results = list(forest)
+        self.assertEqual(len(results), forest.count())
+        self.assertEqual(set(results), forest.evaluate())
+
+
+class DeferredTest(unittest.TestCase):
+    def assertParsesLikeEager(self, grammar, text):
+        eager = pearl.parse(grammar, text)
+        self.assertEqual(pearl.parse(grammar, text, deferred=True), eager)
+        return eager
+
+    def test_unit_cycle(self):
+        grammar = pearl.Grammar().put('__start__', [{'expr'}]).put('expr', ['x'], lambda: 1).put(
+            'expr', [{'expr'}], lambda e: e)
+        self.assertEqual(self.assertParsesLikeEager(grammar, 'x'), {1})
+
+    def test_cycle_building_other_results(self):
+        grammar = pearl.Grammar().put('__start__', [{'aa'}]).put('aa', [{'bb'}]).put('bb', [{'x'}]).put(
+            'bb', ['aa'], lambda: 0)
+        self.assertEqual(self.assertParsesLikeEager(grammar, 'x'), {0, 'x'})
+
+    def test_nullable_cycle(self):
+        grammar = pearl.Grammar().put('__start__', [{'ends'}]).put('ends', [], lambda: frozenset()).put(
+            'ends', [{'ends'}, {'end'}], lambda ends, end: ends | {end}).put('end', [], lambda: 0).put(
+            'end', ['x'], lambda: 1)
+        self.assertParsesLikeEager(grammar, '')
+        self.assertParsesLikeEager(grammar, 'xx')
+
+
+class LeoTest(unittest.TestCase):
+    # Right recursion through links that build results, that only cover text and that pass their child on.
+    grammar = pearl.Grammar().extend([
+        ('__start__', [{'list'}]),
+        ('list', [], lambda: ()),
+        ('list', [{'word'}, ',', {'list'}], lambda word, rest: (word,) + rest),
+        ('list', [';', {'list'}]),
+        ('word', ['letter']), ('word', ['letter', 'word']),
+        ('letter', ['a']), ('letter', ['b']),
+    ])
+
+    def test_right_recursion_builds_like_forests(self):
+        text = 'ab,ba,;;a,bbb,;' * 20
+        result = pearl.parse(self.grammar, text, allow_ambiguous=False)
+        self.assertEqual(result, ('ab', 'ba', 'a', 'bbb') * 20)
+        self.assertEqual(pearl.parse(self.grammar, text, allow_ambiguous=False, deferred=True), result)
+        # Forest items aren't completed through Leo chains.
+        self.assertEqual(pearl.parse(self.grammar, text, output='forest').evaluate(), {result})
+
+    def test_right_recursion_is_linear(self):
+        set_sizes = []
+        for count in (100, 200):
+            stats = pearl.ParseStats()
+            pearl.parse(self.grammar, 'ab,ba,;;a,bbb,;' * count, allow_ambiguous=False, stats=stats)
+            set_sizes.append(max(stats.set_sizes))
+        self.assertEqual(set_sizes[0], set_sizes[1])
+
+
+class ParserTest(unittest.TestCase):
+    grammar = pearl.Grammar().extend([
+        ('__start__', [{'sum'}]), ('sum', [{'number'}]), ('sum', [{'sum'}, '+', {'number'}], lambda a, b: a + b),
+        ('number', [{GrammarTest.digit}], int),
+    ])
+
+    def test_chunks_parse_like_whole_text(self):
+        text = '1+2+3+4'
+        whole = pearl.parse(self.grammar, text, allow_ambiguous=False)
+        for size in range(1, len(text) + 1):
+            parser = pearl.Parser(self.grammar, allow_ambiguous=False)
+            for i in range(0, len(text), size):
+                parser.feed(text[i:i + size])
+            self.assertEqual(parser.finish(), whole)
+
+    def test_expected_after_partial_feed(self):
+        parser = pearl.Parser(self.grammar, allow_ambiguous=False)
+        parser.feed('1+2')
+        self.assertEqual(parser.expected, {'+'})
+        parser.feed('+')
+        self.assertEqual(parser.expected, {GrammarTest.digit})
+        self.assertEqual(parser.position, 4)
+        self.assertEqual(parser.finish('3'), 6)
+
+    def test_text_is_released(self):
+        parser = pearl.Parser(self.grammar, allow_ambiguous=False)
+        parser.feed('1+2+')
+        self.assertEqual(parser._Parser__text.offset, 4)
+        # Results are built from the whole text at the end of deferred parses.
+        parser = pearl.Parser(self.grammar, allow_ambiguous=False, deferred=True)
+        parser.feed('1+2+')
+        self.assertEqual(parser._Parser__text.offset, 0)
+        self.assertEqual(parser.finish('3'), 6)
+
+    def test_stats(self):
+        stats = pearl.ParseStats()
+        pearl.parse(self.grammar, '1+2', stats=stats)
+        self.assertEqual(stats.parses, 1)
+        self.assertEqual(stats.scans, 3)
+        self.assertEqual(stats.predictions, 5)
+        self.assertEqual(stats.completions, 4)
+        self.assertEqual(stats.set_sizes, [4, 3, 2, 3])
+        self.assertEqual(sum(stats.rule_item_counts.values()), sum(stats.set_sizes))
+        pearl.parse(self.grammar, '4', stats=stats)
+        self.assertEqual(stats.parses, 2)
+        self.assertEqual(stats.scans, 4)
+
+
+class LexerTest(unittest.TestCase):
+    lexer = pearl.Lexer([
+        ('KW', 'abc'), ('A', 'a'), ('B', 'b'), ('C', 'c'), (None, r'\s+'), ('ID', '[x-z]+'), ('NUM', r'\d+(?:\.\d+)?'),
+    ])
+
+    grammar = pearl.Grammar().with_lexer(lexer).extend(
+        [('__start__', [{'tokens'}]), ('tokens', [], lambda: ()),
+         ('tokens', [{'tokens'}, {'token'}], lambda tokens, token: tokens + (token.symbol,))]
+        + [('token', [{symbol}]) for symbol in ['KW', 'A', 'B', 'C', 'ID', 'NUM']])
+
+    def parse_chunks(self, text, stops):
+        parser = pearl.Parser(self.grammar, allow_ambiguous=False)
+        start = 0
+        for stop in stops + [len(text)]:
+            parser.feed(text[start:stop])
+            start = stop
+        return parser.finish()
+
+    def test_chunks_lex_like_whole_text(self):
+        # Chunks may end within any token that a longer match doesn't span several of.
+        for text in ['xyz 12.5  zz 3', 'ab cab', ' 1.25 x', 'abc']:
+            whole = pearl.parse(self.grammar, text, allow_ambiguous=False)
+            for stops in ([], *([i] for i in range(len(text) + 1)), list(range(len(text) + 1))):
+                if text == 'abc' and 2 in stops:
+                    continue
+                self.assertEqual(self.parse_chunks(text, stops), whole)
+        self.assertEqual(self.parse_chunks('abc', [1]), ('KW',))
+        self.assertEqual(self.parse_chunks('aabbcc abc 1.2', [8, 13]), ('A', 'A', 'B', 'B', 'C', 'C', 'KW', 'NUM'))
+
+    def test_finish_lexes_the_last_chunk_as_final(self):
+        parser = pearl.Parser(self.grammar, allow_ambiguous=False)
+        parser.feed('xyz 1')
+        self.assertEqual(parser.finish('2.5 abc'), ('ID', 'NUM', 'KW'))
+        with self.assertRaises(pearl.ParseError):
+            pearl.parse(self.grammar, 'xyz 12.')
+
+
+if __name__ == '__main__':
+    unittest.main()